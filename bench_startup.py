@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# (name, arguments, stdin, budget in milliseconds). Run from a directory
+# with a data_path.config, as the tools would be.
+COMMANDS = [
+    ("python", ["-c", "pass"], None, None),
+    ("roll.py d20", ["roll.py", "d20"], None, 50),
+    ("dmtools.py", ["dmtools.py"], "exit\n", 60),
+]
+
+def time_command(arguments, stdin, runs):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    if arguments[0].endswith(".py"):
+        arguments = [os.path.join(directory, arguments[0])] + arguments[1:]
+    times = []
+    for i in range(runs):
+        start = time.time()
+        process = subprocess.Popen([sys.executable] + arguments,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process.communicate(stdin)
+        times.append((time.time() - start)*1000)
+        if process.returncode:
+            raise RuntimeError("%s exited with %i"%(" ".join(arguments),
+                process.returncode))
+    return sorted(times)[runs//2]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time how long the tools take to start.")
+    parser.add_argument("--runs", type=int, default=11)
+    args = parser.parse_args()
+
+    over = False
+    for name, arguments, stdin, budget in COMMANDS:
+        median = time_command(arguments, stdin, args.runs)
+        if budget is None:
+            print "%-12s %6.1f ms"%(name, median)
+        else:
+            print "%-12s %6.1f ms (budget %i ms)%s"%(name, median, budget,
+                "  OVER" if median > budget else "")
+            over = over or median > budget
+    sys.exit(1 if over else 0)
@@ -0,0 +1,127 @@
+import multiprocessing
+import numpy as np
+import rng
+import roll
+
+PLAYERS = 0
+MONSTERS = 1
+
+MAX_ROUNDS = 50
+# Below this many trials a process pool costs more than it saves.
+MIN_PARALLEL_TRIALS = 10000
+
+class Combatant(object):
+    def __init__(self, name, side, hp, ac, attack, damage, initiative):
+        self.name = name
+        self.side = side
+        self.hp = hp
+        self.ac = ac
+        self.attack = attack
+        self.damage = damage
+        self.initiative = initiative
+
+def from_entity(entity, side):
+    try:
+        return Combatant(entity["name"], side, int(entity["hp"]),
+            int(entity["ac"]), str(entity["attack"]), str(entity["damage"]),
+            int(entity.get("initiative", 10)))
+    except (KeyError, ValueError):
+        print "Skipping %s: needs hp, ac, attack and damage"%(
+            entity.get("name", "unnamed entity"))
+        return None
+
+class Result(object):
+    def __init__(self, trials=0, wins=0, losses=0, rounds=0, hp_loss=0):
+        self.trials = trials
+        self.wins = wins
+        self.losses = losses
+        self.rounds = rounds
+        self.hp_loss = hp_loss
+    def __add__(self, other):
+        return Result(self.trials + other.trials, self.wins + other.wins,
+            self.losses + other.losses, self.rounds + other.rounds,
+            self.hp_loss + other.hp_loss)
+    def __str__(self):
+        draws = self.trials - self.wins - self.losses
+        return "%i trials\nPlayers win: %.1f%%  Players lose: %.1f%%  " \
+            "Unresolved after %i rounds: %.1f%%\nExpected rounds: %.2f\n" \
+            "Expected player HP loss: %.2f"%(
+            self.trials, 100.*self.wins/self.trials,
+            100.*self.losses/self.trials, MAX_ROUNDS,
+            100.*draws/self.trials, float(self.rounds)/self.trials,
+            float(self.hp_loss)/self.trials)
+
+def simulate(combatants, n):
+    # Every trial is a column of the same vectorized fight: combatants act
+    # in initiative order and attack a random living enemy.
+    random = rng.stream("combat").numpy
+    combatants = sorted(combatants, key=lambda c: -c.initiative)
+    side = np.array([c.side for c in combatants])
+    ac = np.array([c.ac for c in combatants])
+    attacks = [roll.compile_expression(c.attack) for c in combatants]
+    damages = [roll.compile_expression(c.damage) for c in combatants]
+    hp = np.tile(np.array([c.hp for c in combatants]), (n, 1))
+    start_hp = hp[:, side == PLAYERS].sum(axis=1)
+    rounds = np.full(n, MAX_ROUNDS)
+    live = np.arange(n)
+    for r in range(1, MAX_ROUNDS+1):
+        # Only fights still in progress are rolled for.
+        k = len(live)
+        live_hp = hp[live]
+        trials = np.arange(k)
+        for a in range(len(combatants)):
+            enemies = np.flatnonzero(side != side[a])
+            alive = live_hp[:, enemies] > 0
+            count = alive.sum(axis=1)
+            acting = (live_hp[:, a] > 0) & (count > 0)
+            pick = (random.random_sample(k)*count).astype(int)
+            target = enemies[(np.cumsum(alive, axis=1) >
+                pick[:, None]).argmax(axis=1)]
+            hit = acting & (attacks[a].sample(k) >= ac[target])
+            live_hp[trials, target] -= np.where(hit,
+                damages[a].sample(k).clip(0), 0)
+        hp[live] = live_hp
+        players_alive = (live_hp[:, side == PLAYERS] > 0).any(axis=1)
+        monsters_alive = (live_hp[:, side == MONSTERS] > 0).any(axis=1)
+        finished = ~(players_alive & monsters_alive)
+        rounds[live[finished]] = r
+        live = live[~finished]
+        if not len(live):
+            break
+    players_alive = (hp[:, side == PLAYERS] > 0).any(axis=1)
+    monsters_alive = (hp[:, side == MONSTERS] > 0).any(axis=1)
+    end_hp = hp[:, side == PLAYERS].clip(0).sum(axis=1)
+    return Result(n, (players_alive & ~monsters_alive).sum(),
+        (~players_alive).sum(), rounds.sum(), (start_hp - end_hp).sum())
+
+def _simulate_chunk(args):
+    combatants, n, seed = args
+    rng.use(rng.Session(seed), close=False)
+    return simulate(combatants, n)
+
+def run(combatants, n, workers=None):
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1 or n < MIN_PARALLEL_TRIALS:
+        return simulate(combatants, n)
+    # Chunks get their own streams, so results don't depend on which
+    # worker runs which chunk.
+    sizes = [n/workers + (1 if i < n%workers else 0) for i in range(workers)]
+    chunks = [(combatants, size, session.seed) for size, session in
+              zip(sizes, rng.session.workers(len(sizes)))]
+    rng.flush()
+    pool = multiprocessing.Pool(workers)
+    try:
+        return sum(pool.map(_simulate_chunk, chunks), Result())
+    finally:
+        pool.close()
+        pool.join()
+
+def simulate_encounter(players, monsters, n, workers=None):
+    combatants = [from_entity(p, PLAYERS) for p in players] + \
+                 [from_entity(m, MONSTERS) for m in monsters]
+    combatants = [c for c in combatants if c]
+    if not any(c.side == PLAYERS for c in combatants) or \
+       not any(c.side == MONSTERS for c in combatants):
+        print "Need at least one player and one monster to simulate."
+        return None
+    return run(combatants, n, workers)
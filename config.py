@@ -0,0 +1,38 @@
+import storage
+
+CONFIG_PATH = "data_path.config"
+DEFAULT_DATA_PATH = "data/"
+
+class Config(object):
+    # Settings read from disk the first time they're needed and kept.
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path
+        self._data_path = None
+    @property
+    def data_path(self):
+        if self._data_path is None:
+            self._data_path = read_data_path(self.path)
+        return self._data_path
+    @property
+    def storage(self):
+        return storage.open_storage(self.data_path)
+
+def read_data_path(path):
+    try:
+        with open(path, 'r') as f:
+            data_path = f.readline()
+            if data_path.endswith('\n'):
+                data_path = data_path[:-1]
+            return data_path
+    except IOError:
+        with open(path, 'w') as f:
+            f.write(DEFAULT_DATA_PATH)
+        return DEFAULT_DATA_PATH
+
+config = Config()
+
+def get_data_path():
+    return config.data_path
+
+def get_storage():
+    return config.storage
@@ -1,41 +1,119 @@
 #!/usr/bin/env python
 
+import argparse
+from collections import OrderedDict
 import cmd
+import config
 import encounter
+import entities
+import journal
 import json
-import names
-import npc
-import os
-import printing
+import lazy
+import perf
+import rng
 import roll
+import storage
+from StringIO import StringIO
+import sys
+import threading
+import time
 
-def get_data_path():
-    try:
-        with open("data_path.config", 'r') as f:
-            data_path = f.readline()
-            if data_path.endswith('\n'):
-                data_path = data_path[:-1]
-            return data_path
-    except IOError:
-        with open("data_path.config", 'w') as f:
-            f.write("data/")
-        return "data/"
+# Loaded by the first command that needs them.
+combat = lazy.load("combat")
+names = lazy.load("names")
+npc = lazy.load("npc")
+population = lazy.load("population")
+printing = lazy.load("printing")
+cProfile = lazy.load("cProfile")
+pstats = lazy.load("pstats")
+server = lazy.load("server")
+treasure = lazy.load("treasure")
+
+class ThreadOutput(object):
+    # Stands in for sys.stdout so that each thread can capture what its
+    # commands print without seeing other threads' output.
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+    def target(self):
+        return getattr(self.local, "buffer", None) or self.stream
+    def write(self, string):
+        self.target().write(string)
+    def flush(self):
+        self.target().flush()
+
+def capture(buffer):
+    if not isinstance(sys.stdout, ThreadOutput):
+        sys.stdout = ThreadOutput(sys.stdout)
+    sys.stdout.local.buffer = buffer
+    return sys.stdout
+
+def release():
+    sys.stdout.local.buffer = None
+
+def commands(lines):
+    # Blank lines and lines starting with # are skipped.
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+# Functions shown by the profile command.
+PROFILE_LINES = 20
 
 class DMTools(cmd.Cmd):
     prompt = "\ndmtools > "
-    def __init__(self):
+    # Commands that only generate things, so they can run in any process.
+    STATELESS = ("name", "npc", "roll", "r", "stats", "treasure")
+    def __init__(self, session=None, journaled=True):
+        # session names a separate journal and save directory, e.g. for one
+        # of several tables on a server; an unjournaled instance keeps
+        # nothing between runs.
         cmd.Cmd.__init__(self)
-        self.data_path = get_data_path()
+        self.data_path = config.get_data_path()
+        self.storage = config.get_storage()
+        self.entities = entities.EntityCache(self.storage)
+        self.players = entities.Roster(self.entities, "players")
+        self.rendered = {}
+        self.save_path = "sessions/%s/"%session if session else ""
+        saved = []
+        if not session or self.storage.isfile(self.save_path +
+                                              "encounter.json"):
+            saved = self.load_json(self.save_path + "encounter")
         self.active_entities = \
             {
-                "encounter": self.load_json("encounter"),
+                "encounter": encounter.Encounter(saved or []),
                 "notes": []
             }
         self.previous = None
-        self.current_id = 0
+        self.current_id = self.active_entities["encounter"].max_key()
+        self.population = None
+        self.dirty = set()
+        self.load_players()
+        self.journal = None
+        if journaled:
+            self.journal = journal.Journal(self.storage.local_path(
+                "sessions/%s/"%session if session else "session/"))
+            self.restore()
+            self.journal.open()
                 
     def do_active(self, string):
-        printing.print_json(self.active_entities)
+        printing.print_json(self.serializable(self.active_entities))
+
+    def do_census(self, string):
+        if self.population is None:
+            print "No town loaded. Try town <size> first."
+            return
+        try:
+            matches = self.population.find(string)
+        except ValueError as e:
+            print e
+            return
+        print "%i of %i"%(len(matches), len(self.population))
+        for i in matches[:10]:
+            person = self.population[i]
+            print "%s (%s %s, %s)"%(person.name, person.sex_str(),
+                person.race, person.alignment())
 
     def do_describe(self, string):
         entity = self.load(string)
@@ -50,17 +128,17 @@ class DMTools(cmd.Cmd):
         
     def do_encounter(self, string):
         npcs = encounter.parse(string)
+        spawned = []
         for group in npcs:
+            template = self.load_json(group[0])
             for i in range(group[1]):
-                entity = self.load_json(group[0])
-                entity["key"] = self.get_next_id()
-                entity["hp"] = roll.parse(entity["hp"])
-                entity["initiative"] = roll.parse(entity["DEX"])
-                self.active_entities["encounter"].append(entity)
+                spawned.append([group[0], self.get_next_id(),
+                    roll.parse(template["hp"]), roll.parse(template["DEX"])])
+        self.apply(["e", spawned])
         self.do_status("")
 
     def do_forget(self, string):
-        self.active_entities = {"encounter":[], "notes":[]}
+        self.apply(["f"])
         
     def get_next_id(self):
         self.current_id += 1
@@ -74,41 +152,48 @@ class DMTools(cmd.Cmd):
         if string in self.active_entities:
             return self.active_entities[string]
         else:
-            for npc in self.active_entities["encounter"]:
-                if str(npc["key"]) == str(string):
-                    return npc
+            npc = self.active_entities["encounter"].get(string)
+            if npc:
+                return npc
             entity = self.load_json(string)
         self.active_entities[string] = entity
         return self.active_entities[string]
         
     def load_json(self, string):
         try:
-            with open("%s%s.json"%(self.data_path, string), 'r') as f:
-                    entity = json.load(f)
+            entity = self.entities.spawn(string)
         except IOError:
             print "Couldn't find %s in %s"%(string, self.data_path)
             entity = {}
         return entity
         
     def load_players(self):
-        for name in os.listdir("%s/players"%self.data_path):
-            self.load("players/%s"%name[:-5])
+        changed, removed = self.players.refresh()
+        self.active_entities.update(changed)
+        for string in removed:
+            self.active_entities.pop(string, None)
         
     def do_next(self, string):
-        if self.previous and "next" in self.previous:
+        if string == "turn":
+            current = self.active_entities["encounter"].next_turn()
+            if current:
+                print "Round %i: %s %s (HP %s)"%(
+                    self.active_entities["encounter"].round, current["key"],
+                    current["name"], current["hp"])
+        elif self.previous and "next" in self.previous:
             self.do_describe(self.previous["next"])
             
     def do_n(self, string):
         self.do_next(string)
         
     def do_name(self, string):
-        name = names.generate_name(string)
-        while len(name) < 3:
-            name = names.generate_name(string)
-        print name
+        args = string.split()
+        count = int(args[1]) if len(args) > 1 else 1
+        for name in names.generate_names(args[0], count):
+            print name
 
     def do_note(self, string):
-        self.active_entities["notes"].append(string)
+        self.apply(["n", string])
         
     def do_npc(self, string):
         n = npc.generate_npc(string=string)
@@ -121,7 +206,64 @@ class DMTools(cmd.Cmd):
     def do_p(self, string):
         self.do_previous(string)
 
+    def do_replay(self, string):
+        rng.replay(string)
+        print "Replaying %s (seed %i)"%(string, rng.session.seed)
+
+    def do_perf(self, string):
+        # "perf" shows what timing has recorded, "perf reset" clears it and
+        # "perf dump <path>" writes it out as JSON.
+        args = string.split()
+        if args and args[0] == "reset":
+            perf.reset()
+        elif args and args[0] == "dump":
+            perf.dump(args[1])
+            print "Wrote %s"%args[1]
+        else:
+            if not perf.enabled:
+                print "Timing is off. Try timing on."
+            commands = printing.table(
+                ["Command", "Calls", "Total ms", "Mean ms", "Max ms"])
+            for command, (calls, total, longest) in sorted(
+                    perf.timings.items(), key=lambda t: -t[1][1]):
+                commands.add_row([command, calls, "%.1f"%(total*1000),
+                    "%.1f"%(total*1000/calls), "%.1f"%(longest*1000)])
+            print commands
+            counters = printing.table(["Counter", "Count"])
+            for name, n in sorted(perf.counters.items()):
+                counters.add_row([name, n])
+            print counters
+
+    def do_profile(self, string):
+        # Runs a command under cProfile and shows where the time went.
+        profiler = cProfile.Profile()
+        stop = profiler.runcall(cmd.Cmd.onecmd, self, string)
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats(
+            "cumulative").print_stats(PROFILE_LINES)
+        return stop
+
+    def do_query(self, string):
+        # e.g. "query cr=3 type=undead"
+        try:
+            criteria = storage.parse_criteria(string)
+        except ValueError as e:
+            print e
+            return
+        for path in self.storage.query(**criteria):
+            print path[:-len(".json")]
+
+    def do_remove(self, string):
+        if self.active_entities["encounter"].get(string) is None:
+            print "%s is not in the encounter!"%string
+        else:
+            self.apply(["r", string])
+            self.do_status("")
+
     def do_roll(self, string):
+        n, string = roll.parse_repeat(string)
+        if n is not None:
+            print roll.summary(roll.roll_many(string, n))
+            return
         _,_,_,_, result = roll.parse(string, value_only=False)
         print result
         
@@ -129,6 +271,9 @@ class DMTools(cmd.Cmd):
         self.do_roll(string)
 
     def do_save(self, string):
+        # The journal already holds every change; saving writes out the
+        # entities changed since the last save and folds the journal into a
+        # new snapshot.
         if len(string) > 0:
             if string in self.active_entities:
                 entities_to_save = [string]
@@ -136,76 +281,221 @@ class DMTools(cmd.Cmd):
                 print "%s is not an active entity!"%string
                 return
         else:
-            if len(self.active_entities["notes"]) == 0:
-                del self.active_entities["notes"]
-            entities_to_save = self.active_entities
+            entities_to_save = [key for key in self.dirty
+                                if key in self.active_entities]
+            if len(self.active_entities["notes"]) == 0 and \
+               "notes" in entities_to_save:
+                entities_to_save.remove("notes")
         for key in entities_to_save:
-            with open("%s%s.json"%(self.data_path, key), 'w') as f:
-                json.dump(self.active_entities[key], f, sort_keys=True,
-                    indent=4, separators=(',', ': '))
-        if not "notes" in self.active_entities:
-            self.active_entities["notes"] = []
+            self.storage.write("%s%s.json"%(self.save_path, key), json.dumps(
+                self.serializable(self.active_entities[key]),
+                sort_keys=True, indent=4, separators=(',', ': ')))
+            self.dirty.discard(key)
+        if self.journal:
+            self.journal.compact(self.snapshot())
+
+    def do_seed(self, string):
+        args = string.split()
+        if args:
+            rng.seed(int(args[0]), args[1] if len(args) > 1 else None)
+        print "Session seed: %i"%rng.session.seed
+
+    def serializable(self, value):
+        if isinstance(value, encounter.Encounter):
+            return value.to_list()
+        if isinstance(value, dict):
+            return dict((k, self.serializable(v)) for k, v in value.items())
+        return value
 
     def do_set(self, string):
         name, property, value = string.split(" ", 2)
         entity = self.load(name)
         if value.startswith("--") or value.startswith("++"):
             mod = int(value[2:])
-            entity[property] = int(entity[property]) - mod \
+            value = int(entity[property]) - mod \
                 if value.startswith("--") else int(entity[property]) + mod
-        else:
-            entity[property] = value
+        self.apply(["s", name, property, value])
         if entity in self.active_entities["encounter"]:
             self.do_status("")
         
+    def do_simulate(self, string):
+        self.load_players()
+        players = [self.active_entities[e] for e in self.active_entities
+                   if e.startswith("players/")]
+        result = combat.simulate_encounter(players,
+            self.active_entities["encounter"], int(string) if string else 1000)
+        if result:
+            print result
+
+    def do_stats(self, string):
+        target = None
+        if ">=" in string:
+            string, target = string.split(">=")
+            target = int(target)
+        print roll.distribution(string.strip()).summary(target)
+
     def do_status(self, string):
+        # Only rows that changed since the last status are shown, unless
+        # asked for all of them.
         self.load_players()
-        players_table = printing.table(
-            ["Player", "AC", "Spell save", "Perception"])
-        for entity in self.active_entities:
+        if string == "all":
+            self.rendered = {}
+        rows = OrderedDict()
+        for entity in sorted(self.active_entities):
             if entity.startswith("players/"):
                 player = self.active_entities[entity]
-                players_table.add_row(
-                    [player["name"], player["ac"], player["spell_save"],
-                    player["perception"]])
+                rows[entity] = [player["name"], player["ac"],
+                    player["spell_save"], player["perception"]]
+        for npc in self.active_entities["encounter"]:
+            rows[npc["key"]] = [npc["key"], npc["name"], npc["hp"], npc["ac"],
+                npc["attack"], npc["damage"], npc["initiative"]]
+        players_table = printing.table(
+            ["Player", "AC", "Spell save", "Perception"])
         status_table = printing.table(
             ["key", "Name", "HP", "AC", "Attack", "Damage", "Initiative"])
-        for npc in self.active_entities["encounter"]:
-            status_table.add_row(
-                [npc["key"], npc["name"], npc["hp"], npc["ac"], npc["attack"],
-                    npc["damage"], npc["initiative"]])
-        print players_table
-        print status_table
+        players_changed = status_changed = False
+        for key, row in rows.items():
+            if self.rendered.get(key) != row:
+                if isinstance(key, basestring) and key.startswith("players/"):
+                    players_table.add_row(row)
+                    players_changed = True
+                else:
+                    status_table.add_row(row)
+                    status_changed = True
+        gone = [key for key in self.rendered if key not in rows]
+        self.rendered = rows
+        if players_changed:
+            print players_table
+        if status_changed:
+            print status_table
+        for key in gone:
+            print "%s is gone."%key
 
     def do_treasure(self, string):
-        num, cr = string.split()
-        amount = 0
-        denom = "gp"
-        cr = int(cr)
-        num = int(num)
-        if cr == 0:
-            for i in range(num):
-                amount += roll.parse("1d10")
-                denom = "cp"
-        elif cr < 5:
-            result = roll.parse("d100")
-            for i in range(num):
-                if result < 31:
-                    amount += roll.parse("5d6")
-                    denom = "cp"
-                elif result < 61:
-                    amount += roll.parse("4d6")
-                    denom = "sp"
-                elif result < 71:
-                    amount += roll.parse("3d6")*10
-                    denom = "sp"
-                elif result < 96:
-                    amount += roll.parse("3d6")
-                    denom = "gp"
-                else:
-                    amount += roll.parse("1d6")*10
-                    denom = "gp"
-        print "%i %s"%(amount, denom)
+        # "treasure 200 3" for 200 CR 3 creatures, "treasure hoard 12 [n]"
+        # for hoards.
+        args = string.split()
+        if args and args[0] == "hoard":
+            print treasure.hoard(storage.parse_cr(args[1]),
+                int(args[2]) if len(args) > 2 else 1)
+        else:
+            num, cr = args
+            print treasure.individual(int(num), storage.parse_cr(cr))
+
+    def do_timing(self, string):
+        if string in ("on", "off"):
+            perf.enabled = string == "on"
+        print "Timing is %s"%("on" if perf.enabled else "off")
+
+    def do_town(self, string):
+        args = string.split()
+        path = args[1] if len(args) > 1 \
+            else self.storage.local_path("town.jsonl")
+        n = npc.generate_population(int(args[0]), path)
+        self.population = population.load_jsonl(path)
+        print "Wrote %i NPCs to %s"%(n, path)
+
+    def apply(self, record, replaying=False):
+        # Every change to the session goes through here and into the
+        # journal, so that restore() can play it back.
+        kind = record[0]
+        active = self.active_entities
+        if kind == "s":
+            name, property, value = record[1:]
+            entity = self.load(name)
+            entity[property] = value
+            if entity in active["encounter"]:
+                if property == "initiative":
+                    active["encounter"].update(entity)
+                self.dirty.add("encounter")
+            else:
+                self.dirty.add(name)
+        elif kind == "n":
+            active["notes"].append(record[1])
+            self.dirty.add("notes")
+        elif kind == "e":
+            for path, key, hp, initiative in record[1]:
+                entity = self.load_json(path)
+                entity["key"] = key
+                entity["hp"] = hp
+                entity["initiative"] = initiative
+                active["encounter"].append(entity)
+                self.current_id = max(self.current_id, key)
+            self.dirty.add("encounter")
+        elif kind == "r":
+            active["encounter"].remove(record[1])
+            self.dirty.add("encounter")
+        elif kind == "f":
+            self.active_entities = {"encounter": encounter.Encounter(),
+                                    "notes": []}
+            self.players.reset()
+        if not replaying and self.journal:
+            self.journal.append(record)
+            if self.journal.due():
+                self.journal.compact(self.snapshot())
+
+    def snapshot(self):
+        # Players with no unsaved changes are left out, so that restoring
+        # keeps what load_players read from their files.
+        prefix = self.players.directory + "/"
+        active = dict((key, value)
+                      for key, value in self.active_entities.items()
+                      if not key.startswith(prefix) or key in self.dirty)
+        return {"active": self.serializable(active),
+                "current_id": self.current_id,
+                "dirty": sorted(self.dirty)}
+
+    def restore(self):
+        state = self.journal.state
+        if state:
+            for key, value in state["active"].items():
+                self.active_entities[key] = encounter.Encounter(value) \
+                    if key == "encounter" else value
+            self.current_id = state["current_id"]
+            self.dirty = set(state["dirty"])
+        for record in self.journal.records():
+            self.apply(record, replaying=True)
+
+    def onecmd(self, line):
+        # Every command comes through here, so this is where it's timed.
+        if not perf.enabled:
+            return cmd.Cmd.onecmd(self, line)
+        start = time.time()
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        finally:
+            perf.record(self.parseline(line)[0] or line,
+                time.time() - start)
+
+    def execute(self, line):
+        # Runs one command and returns what it printed as a dict, for batch
+        # mode and the server. Errors are reported rather than raised.
+        buffer = StringIO()
+        self.stdout = capture(buffer)
+        error = None
+        stop = False
+        try:
+            stop = bool(self.onecmd(line))
+        except Exception as e:
+            error = "%s: %s"%(type(e).__name__, e)
+        finally:
+            release()
+        return {"command": line, "output": buffer.getvalue(), "error": error,
+                "stop": stop}
+
+    def run_script(self, lines, out):
+        # One JSON object per command, one per line.
+        for line in commands(lines):
+            result = self.execute(line)
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            if result["stop"]:
+                break
+        self.postloop()
+
+    def postloop(self):
+        if self.journal:
+            self.journal.close()
 
     def do_exit(self, string):
         return True
@@ -218,6 +508,35 @@ class DMTools(cmd.Cmd):
         return True
 
 if __name__ == '__main__':
-    DMTools().cmdloop()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", metavar="FILE",
+        help="run the commands in FILE (- for stdin) and print JSON results")
+    parser.add_argument("--serve", action="store_true",
+        help="serve sessions over HTTP on localhost")
+    parser.add_argument("--port", type=int, default=8023)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--timing", action="store_true",
+        help="time every command; see the perf command")
+    args = parser.parse_args()
+    perf.enabled = args.timing
+
+    if args.serve:
+        server.serve(args.port, args.workers)
+    elif args.script:
+        # stdout is for the JSON results only.
+        buffer = StringIO()
+        capture(buffer)
+        try:
+            tools = DMTools()
+        finally:
+            release()
+        sys.stderr.write(buffer.getvalue())
+        if args.script == "-":
+            tools.run_script(sys.stdin, sys.stdout)
+        else:
+            with open(args.script) as f:
+                tools.run_script(f, sys.stdout)
+    else:
+        DMTools().cmdloop()
 
 
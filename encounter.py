@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import heapq
+import itertools
 import roll
 import os
 
@@ -11,4 +14,67 @@ def parse(string):
         if name[-1] is 's':
             name = name[:-1]
         npcs.append((name, number))
-    return npcs
\ No newline at end of file
+    return npcs
+
+class Encounter(object):
+    # Combatants indexed by key, in the order they joined, plus a heap of
+    # the turns left this round in initiative order. Heap entries for
+    # removed combatants or stale initiatives are skipped when popped.
+    def __init__(self, entities=()):
+        self.entities = OrderedDict()
+        self.order = {}
+        self.versions = {}
+        self.turns = []
+        self.acted = set()
+        self.round = 0
+        self.counter = itertools.count()
+        for entity in entities:
+            self.append(entity)
+    def __contains__(self, entity):
+        return isinstance(entity, dict) and \
+            self.entities.get(str(entity.get("key"))) is entity
+    def __iter__(self):
+        return self.entities.itervalues()
+    def __len__(self):
+        return len(self.entities)
+    def append(self, entity):
+        key = str(entity["key"])
+        self.entities[key] = entity
+        self.order[key] = next(self.counter)
+        self.update(entity)
+    def get(self, key):
+        return self.entities.get(str(key))
+    def remove(self, key):
+        key = str(key)
+        self.order.pop(key, None)
+        self.versions.pop(key, None)
+        self.acted.discard(key)
+        return self.entities.pop(key, None)
+    def update(self, entity):
+        # Call after changing an entity's initiative. If it still has a turn
+        # this round, the turn moves to its new place.
+        key = str(entity["key"])
+        version = self.versions[key] = next(self.counter)
+        if self.round and key not in self.acted:
+            self.push(key, version)
+    def push(self, key, version):
+        initiative = int(self.entities[key].get("initiative", 0))
+        heapq.heappush(self.turns,
+            (-initiative, self.order[key], version, key))
+    def next_turn(self):
+        while self.entities:
+            if not self.turns:
+                self.round += 1
+                self.acted.clear()
+                for key in self.entities:
+                    self.push(key, self.versions[key])
+            _, _, version, key = heapq.heappop(self.turns)
+            if self.versions.get(key) == version:
+                self.acted.add(key)
+                return self.entities[key]
+        return None
+    def max_key(self):
+        keys = [int(key) for key in self.entities if key.isdigit()]
+        return max(keys) if keys else 0
+    def to_list(self):
+        return self.entities.values()
@@ -0,0 +1,78 @@
+import json
+import perf
+
+class EntityCache(object):
+    # Parsed JSON entities keyed by path in the data store. An entity is
+    # re-read only when its mtime changes.
+    def __init__(self, storage):
+        self.storage = storage
+        self.entities = {}
+    def get(self, string):
+        path = "%s.json"%string
+        try:
+            mtime = self.storage.mtime(path)
+        except IOError:
+            self.entities.pop(string, None)
+            raise IOError("No such entity: %s"%path)
+        cached = self.entities.get(string)
+        if cached is None or cached[0] != mtime:
+            perf.count("json parses")
+            cached = self.entities[string] = \
+                (mtime, json.loads(self.storage.read(path)))
+        return cached[1]
+    def spawn(self, string):
+        return copy_entity(self.get(string))
+
+def copy_entity(entity):
+    # A shallow copy: top-level fields such as hp, initiative and key belong
+    # to the copy, anything nested is shared with the cache and must not be
+    # modified in place. Lists of entities, like a saved encounter, copy
+    # each entity.
+    if isinstance(entity, dict):
+        return dict(entity)
+    if isinstance(entity, list):
+        return [copy_entity(e) for e in entity]
+    return entity
+
+class Roster(object):
+    # The files in one directory of the data store, tracked by mtimes alone:
+    # the directory's mtime changes when files are added or removed, each
+    # file's mtime when it is edited.
+    def __init__(self, cache, directory):
+        self.cache = cache
+        self.storage = cache.storage
+        self.directory = directory
+        self.reset()
+    def reset(self):
+        # Everything counts as changed on the next refresh.
+        self.mtime = None
+        self.mtimes = {}
+    def refresh(self):
+        # Returns the entities that are new or changed since the last
+        # refresh, by path, and the paths that have gone.
+        removed = []
+        try:
+            mtime = self.storage.mtime(self.directory)
+        except IOError:
+            # A missing directory is an empty roster.
+            mtime = None
+        if mtime != self.mtime:
+            self.mtime = mtime
+            current = set() if mtime is None else \
+                set("%s/%s"%(self.directory, name[:-5])
+                    for name in self.storage.listdir(self.directory))
+            for string in set(self.mtimes) - current:
+                del self.mtimes[string]
+                removed.append(string)
+            for string in current - set(self.mtimes):
+                self.mtimes[string] = None
+        changed = {}
+        for string in self.mtimes:
+            try:
+                mtime = self.storage.mtime("%s.json"%string)
+            except IOError:
+                continue
+            if mtime != self.mtimes[string]:
+                self.mtimes[string] = mtime
+                changed[string] = self.cache.spawn(string)
+        return changed, removed
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+
+# Records between fsyncs, and between compactions.
+SYNC_EVERY = 16
+COMPACT_EVERY = 1000
+
+class Journal(object):
+    # An append-only log of session changes next to a snapshot of the state
+    # they apply to. Journal files are numbered by generation: the snapshot
+    # of generation g holds everything before journal.g, so the state is
+    # the snapshot plus every journal from its generation on.
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.snapshot_path = os.path.join(path, "snapshot.json")
+        self.generation, self.state = self.read_snapshot()
+        self.file = None
+        self.pending = 0
+        self.appended = 0
+        self.compaction = None
+    def journal_path(self, generation):
+        return os.path.join(self.path, "journal.%i"%generation)
+    def read_snapshot(self):
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            return snapshot["generation"], snapshot["state"]
+        except IOError:
+            return 0, None
+    def records(self):
+        # Appending carries on in the last journal read.
+        generation = self.generation
+        while os.path.isfile(self.journal_path(generation)):
+            self.generation = generation
+            with open(self.journal_path(generation)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A record cut short by a crash.
+                        continue
+                    yield record
+            generation += 1
+    def open(self):
+        # A record cut short by a crash is dropped, so that appending starts
+        # on a line of its own. A journal holds at most COMPACT_EVERY
+        # records, so reading it whole is cheap.
+        path = self.journal_path(self.generation)
+        if os.path.isfile(path):
+            with open(path, 'r+b') as f:
+                data = f.read()
+                if data and not data.endswith("\n"):
+                    f.truncate(data.rfind("\n") + 1)
+        self.file = open(path, 'a')
+    def append(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')) + "\n")
+        self.file.flush()
+        self.pending += 1
+        self.appended += 1
+        if self.pending >= SYNC_EVERY:
+            self.sync()
+    def sync(self):
+        if self.pending:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+    def due(self):
+        return self.appended >= COMPACT_EVERY
+    def compact(self, state):
+        # Start a new journal now and write the snapshot in the background;
+        # the old journal is deleted once the snapshot is safely in place.
+        if self.compaction and self.compaction.is_alive():
+            return
+        self.sync()
+        self.file.close()
+        old = self.journal_path(self.generation)
+        self.generation += 1
+        self.appended = 0
+        self.open()
+        data = json.dumps({"generation": self.generation, "state": state},
+            separators=(',', ':'))
+        self.compaction = threading.Thread(target=self.write_snapshot,
+            args=(data, old))
+        self.compaction.start()
+    def write_snapshot(self, data, old):
+        temporary = self.snapshot_path + ".tmp"
+        with open(temporary, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.snapshot_path)
+        os.remove(old)
+    def close(self):
+        if self.compaction:
+            self.compaction.join()
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,16 @@
+import importlib
+
+class LazyModule(object):
+    # Stands in for a module until one of its attributes is needed. Names
+    # are looked up on the real module every time, so module-level state
+    # such as rng.session stays current.
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+    def __getattr__(self, attribute):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attribute)
+
+def load(name):
+    return LazyModule(name)
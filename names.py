@@ -1,63 +1,228 @@
 #!/usr/bin/env python
 
-import dmtools
-import random
+import bisect
+import config
+import cPickle as pickle
+import perf
+import rng
 
 START_TOKEN = -2
 END_TOKEN = -1
 
+DEPTH = 3
+# Bump when NameModel changes so stale compiled models are rebuilt.
+MODEL_VERSION = 3
+# Give up after this many failed attempts at a name.
+MAX_ATTEMPTS = 1000
+
+_models = {}
+
+def get_path(type, kind):
+    return "names/" + type + "_" + kind
+
+def read_lines(path):
+    return config.get_storage().read(path).splitlines()
+
 def load_tokens(type):
-    path = dmtools.get_data_path() + "names/"
-    path += type + "_tokens.txt"
+    path = get_path(type, "tokens.txt")
     string_to_token = {">": END_TOKEN, "<": START_TOKEN}
     token_to_string = {END_TOKEN: ">", START_TOKEN: "<"}
-    with open(path, 'rb') as f:
-        for i, line in enumerate(f):
-            string_to_token[line.strip()] = i
-            token_to_string[i] = line.strip()
+    for i, line in enumerate(read_lines(path)):
+        string_to_token[line.strip()] = i
+        token_to_string[i] = line.strip()
     return string_to_token, token_to_string
     
-def load_names(type, string_to_token):
-    path = dmtools.get_data_path() + "names/"
-    path += type + "_names.txt"
+def get_names_path(type, gender=None):
+    # A race may have a separate corpus per gender, e.g. elf_female_names.txt.
+    if gender:
+        path = get_path(type, gender + "_names.txt")
+        if config.get_storage().isfile(path):
+            return path
+    return get_path(type, "names.txt")
+
+def load_names(path, trie):
     data = []
-    with open(path, 'rb') as f:
-        for line in f:
-            data += [START_TOKEN] + tokenify(line.strip(), string_to_token) + \
-                [END_TOKEN]
+    for line in read_lines(path):
+        data += [START_TOKEN] + tokenify(line.strip(), trie) + [END_TOKEN]
     return data
     
-def get_next_token(tokens, all_tokens, data, min_length, depth=3):
-    choices = [END_TOKEN]
-    for i, t in enumerate(data[:-depth]):
-        for j in range(len(tokens)+1):
-            if j <= depth:
-                if data[i:i+j] == tokens[-j:]:
-                    choices.append(data[i+j])
-    choice = random.choice(choices)
-    return choice
+class NameModel(object):
+    # Compiled form of the old per-token corpus scan: every context of up to
+    # depth tokens maps to its possible next tokens and their cumulative
+    # counts, so each step is a dict lookup and a bisect.
+    def __init__(self, trie, token_to_string, data, depth=DEPTH):
+        self.trie = trie
+        self.token_to_string = token_to_string
+        self.lengths = dict((token, len(string))
+            for token, string in token_to_string.iteritems())
+        self.lengths[END_TOKEN] = 0
+        self.longest = max(self.lengths.values())
+        self.training = set(name[1:].lower() for name in
+            stringify(data, token_to_string).split(">") if name)
+        self.depth = depth
+        self.counts = [{}]
+        for j in range(1, depth+1):
+            counts = {}
+            for i in xrange(len(data) - depth):
+                following = counts.setdefault(tuple(data[i:i+j]), {})
+                following[data[i+j]] = following.get(data[i+j], 0) + 1
+            self.counts.append(counts)
+        self.table = {}
+        for counts in self.counts:
+            for context in counts:
+                self.compile_context(context)
+    def compile_context(self, context):
+        # The old choice list: one END_TOKEN, plus one entry per occurrence
+        # of each suffix of the context in the corpus.
+        weights = {END_TOKEN: 1}
+        for j in range(1, len(context)+1):
+            following = self.counts[j].get(context[-j:], {})
+            for token, count in following.iteritems():
+                weights[token] = weights.get(token, 0) + count
+        choices = sorted(weights)
+        cumulative = []
+        total = 0
+        for token in choices:
+            total += weights[token]
+            cumulative.append(total)
+        self.table[context] = (choices, cumulative)
+        return self.table[context]
+    def next_token(self, tokens, length=0, min_length=0, max_length=None):
+        # length is the number of characters generated so far. Tokens that
+        # would break the length limits are left out of the draw; returns
+        # None if nothing is left.
+        perf.count("name model steps")
+        context = tuple(tokens[-self.depth:])
+        choices, cumulative = self.table.get(context) or \
+            self.compile_context(context)
+        stream = rng.stream("names")
+        if length >= min_length and \
+           (max_length is None or length + self.longest <= max_length):
+            r = stream.randint(1, cumulative[-1])
+            return choices[bisect.bisect_left(cumulative, r)]
+        allowed = []
+        allowed_cumulative = []
+        allowed_total = 0
+        previous = 0
+        for token, total in zip(choices, cumulative):
+            weight = total - previous
+            previous = total
+            if token == END_TOKEN:
+                ok = length >= min_length
+            else:
+                ok = max_length is None or \
+                    length + self.lengths[token] <= max_length
+            if ok:
+                allowed_total += weight
+                allowed.append(token)
+                allowed_cumulative.append(allowed_total)
+        if not allowed:
+            return None
+        r = stream.randint(1, allowed_total)
+        return allowed[bisect.bisect_left(allowed_cumulative, r)]
+    def generate(self, seed="", min_length=0, max_length=None):
+        for attempt in range(MAX_ATTEMPTS):
+            tokens = tokenify(seed, self.trie)
+            length = len(stringify(tokens, self.token_to_string)) - 1
+            while tokens[-1] != END_TOKEN:
+                token = self.next_token(tokens, length, min_length,
+                    max_length)
+                if token is None:
+                    break
+                tokens.append(token)
+                length += self.lengths[token]
+            else:
+                return stringify(tokens, self.token_to_string)[1:-1].title()
+        raise ValueError("Couldn't generate a name between %s and %s "
+            "characters long"%(min_length, max_length))
 
-def generate_name(type, gender=None, seed="", min_length=3):
+def compile_model(type, names_path):
     string_to_token, token_to_string = load_tokens(type)
-    all_tokens = token_to_string.keys()
-    data = load_names(type, string_to_token)
-    tokens = tokenify(seed, string_to_token)
-    while tokens[-1] != END_TOKEN:
-        tokens.append(get_next_token(tokens, all_tokens, data, min_length))
-    name = stringify(tokens, token_to_string)[1:-1]
-    return name.title()
+    trie = build_trie(string_to_token)
+    data = load_names(names_path, trie)
+    return NameModel(trie, token_to_string, data)
+
+def load_compiled_model(type, gender=None):
+    # The compiled model is kept next to its sources and rebuilt whenever
+    # either of them is modified.
+    store = config.get_storage()
+    names_path = get_names_path(type, gender)
+    sources = [get_path(type, "tokens.txt"), names_path]
+    mtimes = [store.mtime(path) for path in sources]
+    path = names_path[:-len("names.txt")] + "model.pkl"
+    try:
+        version, saved_mtimes, model = pickle.loads(store.read(path))
+        if version == MODEL_VERSION and saved_mtimes == mtimes:
+            return model
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+    model = compile_model(type, names_path)
+    try:
+        store.write(path, pickle.dumps((MODEL_VERSION, mtimes, model),
+            pickle.HIGHEST_PROTOCOL))
+    except IOError:
+        pass
+    return model
+
+def load_model(type, gender=None):
+    key = (type, gender)
+    if key not in _models:
+        if gender and get_names_path(type, gender) == get_names_path(type):
+            _models[key] = load_model(type)
+        else:
+            _models[key] = load_compiled_model(type, gender)
+    return _models[key]
+
+def generate_name(type, gender=None, seed="", min_length=3):
+    return load_model(type, gender).generate(seed, min_length)
+
+def generate_names(type, n, min_length=3, max_length=None,
+                   exclude_training=True, unique=True, gender=None):
+    # Stops early if MAX_ATTEMPTS names in a row are rejected, i.e. the
+    # model has run out of new names.
+    model = load_model(type, gender)
+    seen = set()
+    rejected = 0
+    while n > 0 and rejected < MAX_ATTEMPTS:
+        name = model.generate(min_length=min_length, max_length=max_length)
+        key = name.lower()
+        if (exclude_training and key in model.training) or \
+           (unique and key in seen):
+            rejected += 1
+            continue
+        seen.add(key)
+        rejected = 0
+        n -= 1
+        yield name
     
-def tokenify(string, string_to_token):
+def build_trie(string_to_token):
+    trie = {}
+    for string, token in string_to_token.iteritems():
+        node = trie
+        for c in string:
+            node = node.setdefault(c, {})
+        # None marks the end of a token.
+        node[None] = token
+    return trie
+
+def tokenify(string, trie):
+    # Greedy longest match. Characters that start no token are skipped.
     tokens = []
     i = 0
     while i < len(string):
-        for j in range(len(string), i, -1):
-            current_string = string[i:j]
-            if current_string in string_to_token:
-                tokens.append(string_to_token[current_string])
-                current_string = ""
-                i = j
-                break
+        node = trie
+        token = None
+        j = i
+        while j < len(string) and string[j] in node:
+            node = node[string[j]]
+            j += 1
+            if None in node:
+                token, end = node[None], j
+        if token is None:
+            i += 1
+        else:
+            tokens.append(token)
+            i = end
     if len(tokens) == 0:
         return [START_TOKEN]
     return tokens
@@ -1,7 +1,11 @@
-import dmtools
+import config
+import json
+import multiprocessing
 import names
-import random
+import numpy as np
+import rng
 import roll
+import threading
 
 # Constants
 UNALIGNED = 0
@@ -21,19 +25,118 @@ alignment_to_string = \
     LAWFUL: "lawful"
 }
 
+string_to_alignment = dict((v, k) for k, v in alignment_to_string.items())
+
 FEMALE = 1
 MALE = 2
 
+sex_to_string = {FEMALE: "female", MALE: "male"}
+string_to_sex = dict((v, k) for k, v in sex_to_string.items())
+
+# Built-in tables, overridden by a file of the same name in data/npcs/.
+DEFAULT_TABLES = \
+{
+    "races": [("Human", 140), ("Dwarf", 20), ("Halfling", 10),
+              ("Gnome", 10), ("Elf", 10), ("Half-Elf", 6), ("Half-Orc", 2),
+              ("Dragonborn", 1), ("Tiefling", 1)],
+    "law": [("lawful", 1), ("chaotic", 1), ("neutral", 1)],
+    "morality": [("good", 1), ("evil", 1), ("neutral", 1)],
+    "sexes": [("female", 1), ("male", 1)]
+}
+
+# The trait table behind each of an NPC's notes.
+NOTE_TABLES = ["appearance", "mannerisms", "interaction", "abilities",
+               "abilities", "talents", "ideals_%(moral)s", "ideals_%(law)s",
+               "bonds", "flaws"]
+
+# NPCs generated per task when building a population.
+POPULATION_CHUNK = 500
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+class Table(object):
+    # Walker's alias method, in integers so that both draws go through
+    # Stream.randint and end up in the roll log.
+    def __init__(self, entries, weights=None):
+        if not entries:
+            raise ValueError("A table needs at least one entry")
+        weights = weights or [1]*len(entries)
+        n = len(entries)
+        self.entries = entries
+        self.total = sum(weights)
+        scaled = [w*n for w in weights]
+        self.threshold = [self.total]*n
+        self.alias = range(n)
+        small = [i for i in range(n) if scaled[i] < self.total]
+        large = [i for i in range(n) if scaled[i] >= self.total]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.threshold[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= self.total - scaled[s]
+            (small if scaled[l] < self.total else large).append(l)
+    def __len__(self):
+        return len(self.entries)
+    def sample_index(self, random):
+        i = random.randint(0, len(self.entries)-1)
+        if self.threshold[i] < self.total and \
+           random.randint(0, self.total-1) >= self.threshold[i]:
+            return self.alias[i]
+        return i
+    def sample(self, random):
+        return self.entries[self.sample_index(random)]
+    def sample_many(self, random, n):
+        # Vectorized sample_index, drawing from a NumPy RandomState.
+        i = random.randint(0, len(self.entries), size=n)
+        coin = random.randint(0, self.total, size=n)
+        return np.where(coin < np.asarray(self.threshold)[i], i,
+            np.asarray(self.alias)[i])
+
+def read_table(text):
+    # One entry per line, optionally preceded by an integer weight and a tab.
+    entries = []
+    weights = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        weight, _, entry = line.partition("\t")
+        if entry and weight.isdigit():
+            entries.append(entry.strip())
+            weights.append(int(weight))
+        else:
+            entries.append(line)
+            weights.append(1)
+    return Table(entries, weights)
+
+def load_tables():
+    # Held while loading, so no thread sees the tables half filled.
+    with _tables_lock:
+        if not _tables:
+            for name, rows in DEFAULT_TABLES.items():
+                _tables[name] = Table([r[0] for r in rows],
+                                      [r[1] for r in rows])
+            store = config.get_storage()
+            for filename in store.listdir("npcs"):
+                if filename.endswith(".txt"):
+                    _tables[filename[:-4]] = \
+                        read_table(store.read("npcs/" + filename))
+    return _tables
+
 class NPC(object):
     moral_alignment = 0
     law_alignment = 0
     name = "Unnamed"
     race = "unknown"
     notes = []
+    note_indices = None
     sex = 0
     trade = ""
     def __init__(self):
         super(NPC, self).__init__()
+        self.notes = []
     def alignment(self):
         if self.moral_alignment == UNALIGNED \
            and self.law_alignment == UNALIGNED:
@@ -50,6 +153,16 @@ class NPC(object):
         for note in self.notes:
             return_string += " - " + note + "\n"
         return return_string
+    def to_dict(self):
+        # note_indices lets population.load_jsonl find each note's entry
+        # without parsing the notes' text.
+        return {"name": self.name,
+                "race": self.race,
+                "sex": self.sex_str(),
+                "alignment": self.alignment(),
+                "trade": self.trade,
+                "notes": self.notes,
+                "note_indices": self.note_indices}
     def sex_str(self):
         if self.sex == 1:
             return "female"
@@ -57,7 +170,8 @@ class NPC(object):
             return "male"
         return ""
 
-def generate_name(race):
+def generate_name(race, sex=0):
+    gender = sex_to_string.get(sex)
     race = race.lower()
     if race == "half-elf":
         race = "elf" if roll.parse("d2") == 1 else "human"
@@ -66,83 +180,75 @@ def generate_name(race):
     elif race == "tiefling" and roll.parse("d2") == 2:
         race = "human"
     if roll.parse("d4") < 4:
-        return names.generate_name(race) + " " + names.generate_name(race)
-    return names.generate_name(race)
+        return names.generate_name(race, gender) + " " + \
+            names.generate_name(race)
+    return names.generate_name(race, gender)
+
+def get_note_tables(moral_alignment, law_alignment):
+    alignments = {"moral": alignment_to_string[moral_alignment],
+                  "law": alignment_to_string[law_alignment]}
+    return [name%alignments for name in NOTE_TABLES]
+
+def generate_note_indices(moral_alignment, law_alignment):
+    tables = load_tables()
+    random = rng.stream("npc")
+    indices = [tables[name].sample_index(random)
+               for name in get_note_tables(moral_alignment, law_alignment)]
+    while indices[4] == indices[3] and len(tables["abilities"]) > 1:
+        indices[4] = tables["abilities"].sample_index(random)
+    return indices
+
+def format_notes(indices, moral_alignment, law_alignment):
+    tables = load_tables()
+    notes = [tables[name].entries[i] for name, i in
+        zip(get_note_tables(moral_alignment, law_alignment), indices)]
+    return notes[:6] + ["Ideals: " + notes[6] + ", " + notes[7].lower(),
+                        "Bond: " + notes[8],
+                        "Flaw: " + notes[9]]
 
 def generate_notes(moral_alignment, law_alignment):
-    data_path = dmtools.get_data_path()
-    with open(data_path + "npcs/appearance.txt") as f:
-        appearance = random.choice(f.readlines()).strip()
-    with open(data_path + "npcs/mannerisms.txt") as f:
-        mannerism = random.choice(f.readlines()).strip()
-    with open(data_path + "npcs/interaction.txt") as f:
-        interaction = random.choice(f.readlines()).strip()
-    with open(data_path + "npcs/abilities.txt") as f:
-        abilities = f.readlines()
-        ability1 = random.choice(abilities)
-        abilities.remove(ability1)
-        ability1 = ability1.strip()
-        ability2 = random.choice(abilities).strip()
-    with open(data_path + "npcs/talents.txt") as f:
-        talent = random.choice(f.readlines()).strip()
-    with open(data_path + "npcs/ideals_"
-              + alignment_to_string[moral_alignment] + ".txt") as f:
-        moral_ideal = random.choice(f.readlines()).strip()
-    with open(data_path + "npcs/ideals_"
-              + alignment_to_string[law_alignment] + ".txt") as f:
-        law_ideal = random.choice(f.readlines()).strip()
-    with open(data_path + "npcs/bonds.txt") as f:
-        bond = random.choice(f.readlines()).strip()
-    with open(data_path + "npcs/flaws.txt") as f:
-        flaw = random.choice(f.readlines()).strip()
-    
-    return [appearance,
-            mannerism,
-            interaction,
-            ability1, ability2,
-            talent,
-            "Ideals: " + moral_ideal + ", " + law_ideal.lower(),
-            "Bond: " + bond,
-            "Flaw: " + flaw]
+    return format_notes(
+        generate_note_indices(moral_alignment, law_alignment),
+        moral_alignment, law_alignment)
 
 def generate_npc(string=""):
+        tables = load_tables()
+        random = rng.stream("npc")
         npc = NPC()
-        law = roll.parse("d3")
-        if law == 1:
-            npc.law_alignment = LAWFUL
-        else:
-            npc.law_alignment = CHAOTIC if law == 2 else NEUTRAL
-        moral = roll.parse("d3")
-        if moral == 1:
-            npc.moral_alignment = GOOD
-        else:
-            npc.moral_alignment = EVIL if moral == 2 else NEUTRAL
-        npc.sex = roll.parse("d2")
-        race = roll.parse("d20")
-        if race < 15:
-            npc.race = "Human"
-        elif race < 17:
-            npc.race = "Dwarf"
-        elif race == 17:
-            npc.race = "Halfling"
-        elif race == 18:
-            npc.race = "Gnome"
-        elif race == 19:
-            npc.race = "Elf"
-        else:
-            race = roll.parse("d10")
-            if race < 7:
-                npc.race = "Half-Elf"
-            elif race < 9:
-                npc.race = "Half-Orc"
-            elif race == 9:
-                npc.race = "Dragonborn"
-            else:
-                npc.race = "Tiefling"
-        npc.name = generate_name(npc.race)
+        npc.law_alignment = string_to_alignment[tables["law"].sample(random)]
+        npc.moral_alignment = \
+            string_to_alignment[tables["morality"].sample(random)]
+        npc.sex = string_to_sex[tables["sexes"].sample(random)]
+        npc.race = tables["races"].sample(random)
+        npc.name = generate_name(npc.race, npc.sex)
         npc.trade = generate_trade()
-        npc.notes = generate_notes(npc.moral_alignment, npc.law_alignment)
+        npc.note_indices = generate_note_indices(npc.moral_alignment,
+                                                 npc.law_alignment)
+        npc.notes = format_notes(npc.note_indices, npc.moral_alignment,
+                                 npc.law_alignment)
         return npc
 
+def _generate_chunk(args):
+    n, seed = args
+    rng.use(rng.Session(seed), close=False)
+    return [json.dumps(generate_npc().to_dict()) for i in range(n)]
+
+def generate_population(n, path, workers=None):
+    # Every chunk has its own RNG session, and chunks are written in order
+    # as they finish, so the file is reproducible and nothing accumulates.
+    starts = range(0, n, POPULATION_CHUNK)
+    chunks = [(min(POPULATION_CHUNK, n - start), session.seed) for
+              start, session in zip(starts, rng.session.workers(len(starts)))]
+    rng.flush()
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+    try:
+        with open(path, 'w') as f:
+            for lines in pool.imap(_generate_chunk, chunks):
+                f.write("\n".join(lines) + "\n")
+    finally:
+        pool.close()
+        pool.join()
+    return n
+
 def generate_trade():
     return ""
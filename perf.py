@@ -0,0 +1,35 @@
+from collections import defaultdict
+import json
+
+# Off until turned on with the timing command or --timing.
+enabled = False
+
+# command -> [calls, total seconds, longest]
+timings = {}
+counters = defaultdict(int)
+
+def count(name, n=1):
+    if enabled:
+        counters[name] += n
+
+def record(command, seconds):
+    timing = timings.setdefault(command, [0, 0., 0.])
+    timing[0] += 1
+    timing[1] += seconds
+    timing[2] = max(timing[2], seconds)
+
+def reset():
+    timings.clear()
+    counters.clear()
+
+def stats():
+    return {"commands": dict((command, {"calls": calls, "total": total,
+                                        "max": longest})
+                             for command, (calls, total, longest)
+                             in timings.items()),
+            "counters": dict(counters)}
+
+def dump(path):
+    with open(path, 'w') as f:
+        json.dump(stats(), f, sort_keys=True, indent=4,
+            separators=(',', ': '))
@@ -0,0 +1,143 @@
+import json
+import npc
+import numpy as np
+import perf
+import rng
+
+# Columns of Population.notes that index a table fixed by the NPC's
+# alignment rather than by NOTE_TABLES alone.
+MORAL_IDEAL = 6
+LAW_IDEAL = 7
+
+class Population(object):
+    # A city's worth of NPCs held as columns: small-int codes for race, sex
+    # and alignment, and indices into the trait tables for notes. NPC
+    # objects are only built when one is looked at.
+    def __init__(self, names, race, sex, law, morality, notes):
+        self.names = names
+        self.race = race
+        self.sex = sex
+        self.law = law
+        self.morality = morality
+        self.notes = notes
+    def __len__(self):
+        return len(self.names)
+    def __getitem__(self, i):
+        tables = npc.load_tables()
+        person = npc.NPC()
+        person.name = self.names[i]
+        person.race = tables["races"].entries[self.race[i]]
+        person.sex = int(self.sex[i])
+        person.law_alignment = int(self.law[i])
+        person.moral_alignment = int(self.morality[i])
+        person.note_indices = [int(index) for index in self.notes[i]]
+        person.notes = npc.format_notes(person.note_indices,
+            person.moral_alignment, person.law_alignment)
+        return person
+    def nbytes(self):
+        return sum(column.nbytes for column in
+            [self.names, self.race, self.sex, self.law, self.morality,
+             self.notes])
+    def select(self, race=None, sex=None, law=None, morality=None):
+        mask = np.ones(len(self), dtype=bool)
+        if race is not None:
+            races = npc.load_tables()["races"].entries
+            mask &= self.race == races.index(race)
+        for column, value in [(self.sex, sex), (self.law, law),
+                              (self.morality, morality)]:
+            if value is not None:
+                mask &= column == value
+        return np.flatnonzero(mask)
+    def find(self, query):
+        return self.select(**parse_query(query))
+
+def parse_query(query):
+    # "lawful evil dwarves" -> {"race": "Dwarf", "law": LAWFUL,
+    # "morality": EVIL}; "true neutral" is neutral on both axes.
+    races = dict((race.lower(), race)
+                 for race in npc.load_tables()["races"].entries)
+    words = query.lower().split()
+    criteria = {}
+    for i, word in enumerate(words):
+        singular = [word, word[:-1], word[:-3] + "f"]
+        if word == "true" and words[i+1:i+2] == ["neutral"]:
+            criteria["law"] = criteria["morality"] = npc.NEUTRAL
+        elif word == "neutral" and words[i-1:i] == ["true"]:
+            continue
+        elif word in ("lawful", "chaotic"):
+            criteria["law"] = npc.string_to_alignment[word]
+        elif word in ("good", "evil"):
+            criteria["morality"] = npc.string_to_alignment[word]
+        elif word == "neutral":
+            following = words[i+1] if i+1 < len(words) else None
+            if "law" in criteria and following not in ("good", "evil",
+                                                       "neutral"):
+                criteria["morality"] = npc.NEUTRAL
+            else:
+                criteria["law"] = npc.NEUTRAL
+        elif word in npc.string_to_sex:
+            criteria["sex"] = npc.string_to_sex[word]
+        elif any(s in races for s in singular):
+            criteria["race"] = races[[s for s in singular if s in races][0]]
+        else:
+            raise ValueError("Don't know how to look for '%s'"%word)
+    return criteria
+
+def from_codes(names, race, sex, law, morality, notes):
+    return Population(np.array(names), np.asarray(race, dtype=np.uint8),
+        np.asarray(sex, dtype=np.uint8), np.asarray(law, dtype=np.uint8),
+        np.asarray(morality, dtype=np.uint8),
+        np.asarray(notes, dtype=np.uint16))
+
+def generate(n):
+    # Codes and notes are drawn for everyone at once; only names need a
+    # loop.
+    tables = npc.load_tables()
+    random = rng.stream("npc").numpy
+    race = tables["races"].sample_many(random, n)
+    sex = np.array([npc.string_to_sex[s] for s in tables["sexes"].entries]
+        )[tables["sexes"].sample_many(random, n)]
+    law = np.array([npc.string_to_alignment[a]
+        for a in tables["law"].entries])[tables["law"].sample_many(random, n)]
+    morality = np.array([npc.string_to_alignment[a]
+        for a in tables["morality"].entries]
+        )[tables["morality"].sample_many(random, n)]
+    notes = np.zeros((n, len(npc.NOTE_TABLES)), dtype=np.uint16)
+    for column, name in enumerate(npc.NOTE_TABLES):
+        if column == MORAL_IDEAL or column == LAW_IDEAL:
+            alignments = morality if column == MORAL_IDEAL else law
+            for alignment in np.unique(alignments):
+                rows = np.flatnonzero(alignments == alignment)
+                table = tables["ideals_" +
+                               npc.alignment_to_string[alignment]]
+                notes[rows, column] = table.sample_many(random, len(rows))
+        else:
+            notes[:, column] = tables[name].sample_many(random, n)
+    abilities = tables["abilities"]
+    same = np.flatnonzero(notes[:, 3] == notes[:, 4])
+    while len(same) and len(abilities) > 1:
+        notes[same, 4] = abilities.sample_many(random, len(same))
+        same = same[notes[same, 3] == notes[same, 4]]
+    races = tables["races"].entries
+    names = [npc.generate_name(races[r], s) for r, s in zip(race, sex)]
+    return from_codes(names, race, sex, law, morality, notes)
+
+def load_jsonl(path):
+    # Reads the output of npc.generate_population back into columns.
+    tables = npc.load_tables()
+    races = dict((r, i) for i, r in enumerate(tables["races"].entries))
+    names, race, sex, law, morality, notes = [], [], [], [], [], []
+    perf.count("file opens")
+    with open(path) as f:
+        for line in f:
+            perf.count("json parses")
+            record = json.loads(line)
+            law_alignment, moral_alignment = [npc.string_to_alignment[a]
+                for a in record["alignment"].split()]
+            names.append(record["name"].encode("utf-8"))
+            race.append(races[record["race"]])
+            sex.append(npc.string_to_sex[record["sex"]])
+            law.append(law_alignment)
+            morality.append(moral_alignment)
+            notes.append(record["note_indices"])
+    return from_codes(names, race, sex, law, morality, notes)
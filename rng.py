@@ -0,0 +1,161 @@
+from collections import defaultdict, deque
+import hashlib
+import lazy
+import os
+import random
+import struct
+
+np = lazy.load("numpy")
+
+LOG_MAGIC = "DMRL"
+LOG_VERSION = 1
+
+_log_header = struct.Struct("<4sBQ")
+# (stream index, sides, value). sides == 0 declares a stream: value is the
+# length of the stream name, which follows the record.
+_log_record = struct.Struct("<HII")
+
+def derive_seed(seed, name):
+    digest = hashlib.sha256("%i/%s"%(seed, name)).digest()
+    return struct.unpack("<Q", digest[:8])[0]
+
+def random_seed():
+    return struct.unpack("<Q", os.urandom(8))[0]
+
+class RollLog(object):
+    def __init__(self, path, seed):
+        self.file = open(path, 'wb')
+        self.file.write(_log_header.pack(LOG_MAGIC, LOG_VERSION, seed))
+        self.streams = {}
+    def register(self, name):
+        if name not in self.streams:
+            index = self.streams[name] = len(self.streams)
+            self.file.write(_log_record.pack(index, 0, len(name)) + name)
+        return self.streams[name]
+    def write(self, index, sides, value):
+        self.file.write(_log_record.pack(index, sides, value))
+    def flush(self):
+        self.file.flush()
+    def close(self):
+        self.file.close()
+
+def read_log(path):
+    with open(path, 'rb') as f:
+        magic, version, seed = _log_header.unpack(f.read(_log_header.size))
+        if magic != LOG_MAGIC or version != LOG_VERSION:
+            raise ValueError("%s is not a roll log"%path)
+        names = {}
+        rolls = []
+        while True:
+            record = f.read(_log_record.size)
+            if len(record) < _log_record.size:
+                break
+            index, sides, value = _log_record.unpack(record)
+            if sides == 0:
+                names[index] = f.read(value)
+            else:
+                rolls.append((names[index], sides, value))
+    return seed, rolls
+
+class Stream(object):
+    def __init__(self, seed, name, log=None):
+        self.seed = seed
+        self.name = name
+        self.random = random.Random(seed)
+        self._numpy = None
+        self.log = log
+        self.index = log.register(name) if log else None
+    @property
+    def numpy(self):
+        # Created on first use, as importing NumPy is most of startup time.
+        if self._numpy is None:
+            self._numpy = np.random.RandomState(
+                [self.seed & 0xffffffff, self.seed >> 32])
+        return self._numpy
+    def spawn(self, name):
+        return Stream(derive_seed(self.seed, name),
+            self.name + "/" + name, self.log)
+    def randint(self, a, b):
+        value = self.random.randint(a, b)
+        if self.log:
+            self.log.write(self.index, b-a+1, value-a)
+        return value
+    def choice(self, seq):
+        return seq[self.randint(0, len(seq)-1)]
+
+class ReplayStream(Stream):
+    def __init__(self, seed, name, rolls):
+        super(ReplayStream, self).__init__(seed, name)
+        self.rolls = rolls
+    def randint(self, a, b):
+        if not self.rolls:
+            raise ValueError("Roll log for %s is exhausted"%self.name)
+        sides, value = self.rolls.popleft()
+        if sides != b-a+1:
+            raise ValueError("Replay of %s diverged: expected d%i, got d%i"%(
+                self.name, sides, b-a+1))
+        return a + value
+
+class Session(object):
+    def __init__(self, seed=None, log_path=None):
+        self.seed = random_seed() if seed is None else seed
+        self.log = RollLog(log_path, self.seed) if log_path else None
+        self.streams = {}
+        self.batches = 0
+    def stream(self, name):
+        if name not in self.streams:
+            self.streams[name] = Stream(derive_seed(self.seed, name), name,
+                self.log)
+        return self.streams[name]
+    def workers(self, n):
+        # Sessions for one parallel run's n chunks. Each call gets a new
+        # batch, so repeated runs differ but a seeded session still
+        # reproduces them all.
+        batch = self.batches
+        self.batches += 1
+        return [Session(derive_seed(self.seed, "worker/%i/%i"%(batch, i)))
+                for i in range(n)]
+    def flush(self):
+        if self.log:
+            self.log.flush()
+    def close(self):
+        if self.log:
+            self.log.close()
+
+class ReplaySession(Session):
+    def __init__(self, path):
+        seed, rolls = read_log(path)
+        super(ReplaySession, self).__init__(seed)
+        self.rolls = defaultdict(deque)
+        for name, sides, value in rolls:
+            self.rolls[name].append((sides, value))
+    def stream(self, name):
+        if name not in self.streams:
+            self.streams[name] = ReplayStream(derive_seed(self.seed, name),
+                name, self.rolls[name])
+        return self.streams[name]
+
+session = Session()
+
+def use(new_session, close=True):
+    # Forked workers pass close=False: the session they inherit, and its
+    # log, are the parent's.
+    global session
+    if close:
+        session.close()
+    session = new_session
+    return session
+
+def flush():
+    # Before forking, so workers don't inherit buffered rolls that they
+    # would write out again when their copy of the log is collected.
+    session.flush()
+
+def seed(value=None, log_path=None):
+    return use(Session(value, log_path))
+
+def replay(path):
+    return use(ReplaySession(path))
+
+def stream(name):
+    return session.stream(name)
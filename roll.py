@@ -1,46 +1,287 @@
 #!/usr/bin/env python
 
 import argparse
-import random
+from collections import OrderedDict
+import lazy
+import perf
 import re
+import rng
+import threading
+
+np = lazy.load("numpy")
+
+CACHE_SIZE = 256
+# How many times an exploding die is followed when computing exact
+# distributions. The remaining probability mass is negligible.
+EXPLODE_DEPTH = 8
+
+# An optional sign, then either NdM with modifiers or a constant, then an
+# optional multiplier.
+_term = re.compile(r'([+-])?(?:(\d*)d(\d+)((?:!|k[hl]?\d+)*)|(\d+))(?:\*(\d+))?')
+_modifier = re.compile(r'!|k([hl]?)(\d+)')
+_repeat = re.compile(r'\s*(\d+)x\s*(.*)$')
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_pool_cache = {}
+
+class Distribution(object):
+    def __init__(self, offset, pmf):
+        self.offset = offset
+        self.pmf = pmf
+    def __add__(self, other):
+        if not isinstance(other, Distribution):
+            return Distribution(self.offset + other, self.pmf)
+        return Distribution(self.offset + other.offset,
+            np.convolve(self.pmf, other.pmf))
+    def scale(self, k):
+        if k == 0:
+            return Distribution(0, np.ones(1))
+        pmf = np.zeros((len(self.pmf)-1)*abs(k) + 1)
+        pmf[::abs(k)] = self.pmf
+        if k > 0:
+            return Distribution(self.offset*k, pmf)
+        return Distribution(self.maximum()*k, pmf[::-1])
+    def values(self):
+        return np.arange(self.offset, self.offset + len(self.pmf))
+    def minimum(self):
+        return self.offset
+    def maximum(self):
+        return self.offset + len(self.pmf) - 1
+    def mean(self):
+        return np.dot(self.values(), self.pmf)
+    def variance(self):
+        return np.dot((self.values() - self.mean())**2, self.pmf)
+    def percentile(self, p):
+        i = np.searchsorted(np.cumsum(self.pmf), p/100. - 1e-12)
+        return self.offset + min(i, len(self.pmf)-1)
+    def at_least(self, target):
+        return self.pmf[max(0, target - self.offset):].sum()
+    def summary(self, target=None):
+        string = "mean %.2f, variance %.2f, std %.2f, min %i, max %i\n" \
+            "5%%: %i  25%%: %i  50%%: %i  75%%: %i  95%%: %i"%(
+            (self.mean(), self.variance(), np.sqrt(self.variance()),
+            self.minimum(), self.maximum()) +
+            tuple(self.percentile(p) for p in [5, 25, 50, 75, 95]))
+        if target is not None:
+            string += "\nP(result >= %i) = %.4f"%(target,
+                self.at_least(target))
+        return string
+
+class Dice(object):
+    def __init__(self, count, sides, keep=None, highest=True, explode=False,
+                 multiplier=1):
+        if sides < 1:
+            raise ValueError("Dice must have at least one side")
+        if explode and sides == 1:
+            raise ValueError("A d1 can't explode")
+        self.count = count
+        self.sides = sides
+        self.keep = keep if keep is None else min(keep, count)
+        self.highest = highest
+        self.explode = explode
+        self.multiplier = multiplier
+    def roll_die(self, stream):
+        value = stream.randint(1, self.sides)
+        total = value
+        while self.explode and value == self.sides:
+            value = stream.randint(1, self.sides)
+            total += value
+        return total
+    def roll(self):
+        stream = rng.stream("roll")
+        if self.keep is None and not self.explode:
+            total = 0
+            for i in xrange(self.count):
+                total += stream.randint(1, self.sides)
+            return total*self.multiplier
+        rolls = [self.roll_die(stream) for i in xrange(self.count)]
+        if self.keep is not None:
+            rolls.sort(reverse=self.highest)
+            rolls = rolls[:self.keep]
+        return sum(rolls)*self.multiplier
+    def sample_die(self, shape):
+        random = rng.stream("roll").numpy
+        values = random.randint(1, self.sides+1, size=shape)
+        if self.explode:
+            exploding = values == self.sides
+            while exploding.any():
+                extra = random.randint(1, self.sides+1,
+                    size=exploding.sum())
+                values[exploding] += extra
+                exploding[exploding] = extra == self.sides
+        return values
+    def sample(self, n):
+        rolls = self.sample_die((n, self.count))
+        if self.keep is not None:
+            rolls.sort(axis=1)
+            rolls = rolls[:, rolls.shape[1]-self.keep:] if self.highest \
+                else rolls[:, :self.keep]
+        return rolls.sum(axis=1)*self.multiplier
+    def die_distribution(self):
+        if not self.explode:
+            return Distribution(1, np.full(self.sides, 1./self.sides))
+        pmf = np.zeros(self.sides*(EXPLODE_DEPTH+1))
+        for depth in range(EXPLODE_DEPTH+1):
+            p = (1./self.sides)**(depth+1)
+            start = depth*self.sides
+            if depth < EXPLODE_DEPTH:
+                pmf[start:start+self.sides-1] += p
+            else:
+                pmf[start:start+self.sides] += p
+        return Distribution(1, pmf)
+    def pool_distribution(self, count):
+        # Split pools in half so that e.g. 10d6 is reused for 20d6.
+        key = (self.sides, self.explode, count)
+        if key not in _pool_cache:
+            if count == 0:
+                _pool_cache[key] = Distribution(0, np.ones(1))
+            elif count == 1:
+                _pool_cache[key] = self.die_distribution()
+            else:
+                _pool_cache[key] = self.pool_distribution(count/2) + \
+                    self.pool_distribution(count - count/2)
+        return _pool_cache[key]
+    def keep_distribution(self):
+        # Assign dice to faces from the best face down; the first self.keep
+        # dice assigned are the ones kept.
+        die = self.die_distribution()
+        faces = list(enumerate(die.values()))
+        if self.highest:
+            faces.reverse()
+        n, k = self.count, self.keep
+        states = {0: np.ones(1)}
+        for i, v in faces:
+            p = die.pmf[i]
+            new_states = {}
+            for m, sums in states.iteritems():
+                factor = 1.
+                for j in range(n-m+1):
+                    shift = v*min(j, max(0, k-m))
+                    new = new_states.get(m+j)
+                    if new is None or len(new) < len(sums) + shift:
+                        grown = np.zeros(len(sums) + shift)
+                        if new is not None:
+                            grown[:len(new)] += new
+                        new = new_states[m+j] = grown
+                    new[shift:shift+len(sums)] += factor*sums
+                    factor *= p*(n-m-j)/(j+1.)
+            states = new_states
+        sums = states[n]
+        nonzero = np.flatnonzero(sums)
+        return Distribution(nonzero[0], sums[nonzero[0]:nonzero[-1]+1])
+    def distribution(self):
+        if self.keep is not None and self.keep < self.count:
+            d = self.keep_distribution()
+        else:
+            d = self.pool_distribution(self.count)
+        return d.scale(self.multiplier)
+
+class Expression(object):
+    def __init__(self, source, dice, constant):
+        self.source = source
+        self.dice = dice
+        self.constant = constant
+    def roll_dice(self):
+        total = 0
+        for d in self.dice:
+            total += d.roll()
+        return total
+    def roll(self):
+        return self.roll_dice() + self.constant
+    def sample(self, n):
+        results = np.full(n, self.constant, dtype=np.int64)
+        for d in self.dice:
+            results += d.sample(n)
+        return results
+    def distribution(self):
+        total = Distribution(self.constant, np.ones(1))
+        for d in self.dice:
+            total += d.distribution()
+        return total
+
+def compile_expression(string):
+    # Server tables share the cache from their own threads.
+    with _cache_lock:
+        try:
+            expression = _cache.pop(string)
+        except KeyError:
+            expression = _compile(string)
+            if len(_cache) >= CACHE_SIZE:
+                _cache.popitem(last=False)
+        _cache[string] = expression
+    return expression
+
+def _compile(string):
+    # Like the original single-term regex, parse as much of the string as
+    # makes sense and ignore the rest, so "7 (2d6)" is 7.
+    source = string.replace(" ", "")
+    dice = []
+    constant = 0
+    pos = 0
+    while pos < len(source):
+        m = _term.match(source, pos)
+        if not m or m.end() == pos or (pos > 0 and not m.group(1)):
+            break
+        sign = -1 if m.group(1) == '-' else 1
+        multiplier = int(m.group(6)) if m.group(6) else 1
+        if m.group(3):
+            keep = None
+            highest = True
+            explode = False
+            for mod in _modifier.finditer(m.group(4)):
+                if mod.group(0) == '!':
+                    explode = True
+                else:
+                    keep = int(mod.group(2))
+                    highest = mod.group(1) != 'l'
+            dice.append(Dice(int(m.group(2) or 1), int(m.group(3)), keep,
+                highest, explode, sign*multiplier))
+        else:
+            constant += sign*multiplier*int(m.group(5))
+        pos = m.end()
+    # A bare modifier such as "+2" (or nothing at all) is a d20 roll.
+    if pos == 0 or source[0] in "+-":
+        dice.insert(0, Dice(1, 20))
+    return Expression(string, dice, constant)
+
+def roll_many(string, n):
+    return compile_expression(string).sample(n)
+
+def distribution(string):
+    return compile_expression(string).distribution()
+
+def parse_repeat(string):
+    # "10000x 8d6+3" -> (10000, "8d6+3"); anything else -> (None, string)
+    m = _repeat.match(string)
+    if m:
+        return int(m.group(1)), m.group(2)
+    return None, string
+
+def summary(results):
+    if not len(results):
+        return "0 rolls"
+    percentiles = np.percentile(results, [5, 25, 50, 75, 95])
+    return "%i rolls: mean %.2f, std %.2f, min %i, max %i\n" \
+        "5%%: %g  25%%: %g  50%%: %g  75%%: %g  95%%: %g"%(
+        (len(results), results.mean(), results.std(), results.min(),
+        results.max()) + tuple(percentiles))
 
 def parse(string, value_only=True):
-    pattern = '((\d+)?(d(\d+)))?(([+-])?(\d+))?'
-    inp = re.match(pattern, string)
-    groups = inp.groups()
-    # groups:
-    # 1: Number of dice rolled
-    # 3: Type
-    # 5: Operator (+/-/None)
-    # 6: Number to add or subtract
-    num_dice = groups[1]
-    type_dice = groups[3]
-    op = groups[5]
-    mod = groups[6]
-    
-    if mod and not op:
-        if value_only:
-            return int(mod)
-        return int(mod), None, None, int(mod), str(mod)
-    
-    if not num_dice:
-        num_dice = 1
-    if not type_dice:
-        type_dice = 20
-    if not op:
-        op = '+'
-    if not mod:
-        mod = 0
-    mod = int(mod)
-    
-    total = 0
-    for i in range(int(num_dice)):
-        total += random.randint(1, int(type_dice))
-    result = total + mod if op == '+' else total - mod
-    
+    perf.count("roll.parse calls")
+    expression = compile_expression(string)
     if value_only:
-        return result
-    if not op or mod == 0:
+        return expression.roll()
+    if not expression.dice:
+        mod = expression.constant
+        return mod, None, None, mod, str(mod)
+
+    total = expression.roll_dice()
+    op = '+' if expression.constant >= 0 else '-'
+    mod = abs(expression.constant)
+    result = total + expression.constant
+
+    if mod == 0:
         string = str(result)
     else:
         string = "%i %s %i = %i"%(total, op, mod, result)
@@ -48,10 +289,23 @@ def parse(string, value_only=True):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("string", nargs='?', default="d20")
+    parser.add_argument("string", nargs='*', default=["d20"])
     parser.add_argument("--twice", action="store_true")
+    parser.add_argument("--stats", action="store_true")
+    parser.add_argument("--target", type=int)
+    parser.add_argument("--seed", type=int)
     args = parser.parse_args()
 
-    for i in range(2 if args.twice else 1):
-        total, op, mod, result, string = parse(args.string, value_only=False)
-        print string
+    if args.seed is not None:
+        rng.seed(args.seed)
+
+    n, expression = parse_repeat(" ".join(args.string))
+    if args.stats or args.target is not None:
+        print distribution(expression).summary(args.target)
+    elif n is not None:
+        print summary(roll_many(expression, n))
+    else:
+        for i in range(2 if args.twice else 1):
+            total, op, mod, result, string = parse(expression,
+                value_only=False)
+            print string
@@ -0,0 +1,120 @@
+import BaseHTTPServer
+import dmtools
+import json
+import multiprocessing
+import re
+import rng
+import SocketServer
+import threading
+
+# Commands that would change the RNG session every table shares.
+SHARED_COMMANDS = ("seed", "replay")
+
+_table_path = re.compile(r'^/tables/([A-Za-z0-9_-]+)/?$')
+
+_scratch = None
+
+def _init_worker():
+    global _scratch
+    rng.use(rng.Session(), close=False)
+    _scratch = dmtools.DMTools(journaled=False)
+
+def _execute(line):
+    return _scratch.execute(line)
+
+class Table(object):
+    # One game's session. Its commands run one at a time; commands that
+    # only generate things go to the worker pool instead.
+    def __init__(self, name, pool):
+        self.tools = dmtools.DMTools(session=name)
+        self.lock = threading.Lock()
+        self.pool = pool
+    def execute(self, line):
+        words = line.split()
+        command = words[0]
+        # profile runs the rest of the line as a command.
+        while words and words[0] == "profile":
+            words = words[1:]
+        if words and words[0] in SHARED_COMMANDS:
+            return {"command": line, "output": "", "stop": False,
+                "error": "%s isn't available on a shared server"%words[0]}
+        if self.pool and command in dmtools.DMTools.STATELESS:
+            return self.pool.apply(_execute, (line,))
+        with self.lock:
+            return self.tools.execute(line)
+    def close(self):
+        with self.lock:
+            self.tools.postloop()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # GET /tables lists the open tables. POST /tables/<name> runs the
+    # commands in the body, one per line, at that table, opening it if need
+    # be, and returns a list of results as DMTools.execute gives them.
+    def do_GET(self):
+        if self.path.rstrip("/") == "/tables":
+            self.respond(200, sorted(self.server.tables))
+        else:
+            self.respond(404, {"error": "No such resource: %s"%self.path})
+    def do_POST(self):
+        match = _table_path.match(self.path)
+        if not match:
+            self.respond(404, {"error": "No such table: %s"%self.path})
+            return
+        name = match.group(1)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        table = self.server.table(name)
+        results = []
+        for line in dmtools.commands(body.splitlines()):
+            results.append(table.execute(line))
+            if results[-1]["stop"]:
+                self.server.close(name)
+                break
+        self.respond(200, results)
+    def respond(self, status, value):
+        data = json.dumps(value)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # A thread per request, so a slow command at one table doesn't hold up
+    # the others.
+    daemon_threads = True
+    def __init__(self, address, pool=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.pool = pool
+        self.tables = {}
+        self.tables_lock = threading.Lock()
+    def table(self, name):
+        with self.tables_lock:
+            if name not in self.tables:
+                self.tables[name] = Table(name, self.pool)
+            return self.tables[name]
+    def close(self, name):
+        with self.tables_lock:
+            table = self.tables.pop(name, None)
+        if table:
+            table.close()
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        for name in list(self.tables):
+            self.close(name)
+
+def serve(port, workers=None):
+    # workers=0 runs everything in the server process.
+    rng.flush()
+    pool = multiprocessing.Pool(workers, _init_worker) \
+        if workers != 0 else None
+    httpd = Server(("127.0.0.1", port), pool)
+    print "Serving tables on http://127.0.0.1:%i/tables"%port
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if pool:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,202 @@
+import multiprocessing
+import numpy as np
+
+# A NumPy port of snoise2 from the noise package (1.2.2), evaluating whole
+# arrays of points at once. It works in float32 and in the same order as the
+# C code, so fields come out the same as the package's.
+
+PERM = np.array([
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225,
+    140, 36, 103, 30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148, 247,
+    120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32, 57, 177,
+    33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175, 74, 165,
+    71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122, 60, 211,
+    133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54, 65, 25,
+    63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169, 200, 196,
+    135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3, 64, 52, 217,
+    226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85, 212, 207, 206,
+    59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170, 213, 119, 248,
+    152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43, 172, 9, 129, 22,
+    39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185, 112, 104, 218,
+    246, 97, 228, 251, 34, 242, 193, 238, 210, 144, 12, 191, 179, 162, 241,
+    81, 51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31, 181, 199, 106, 157,
+    184, 84, 204, 176, 115, 121, 50, 45, 127, 4, 150, 254, 138, 236, 205, 93,
+    222, 114, 67, 29, 24, 72, 243, 141, 128, 195, 78, 66, 215, 61, 156, 180]*2,
+    dtype=np.intp)
+
+GRAD3 = np.array([
+    [1, 1, 0], [-1, 1, 0], [1, -1, 0], [-1, -1, 0],
+    [1, 0, 1], [-1, 0, 1], [1, 0, -1], [-1, 0, -1],
+    [0, 1, 1], [0, -1, 1], [0, 1, -1], [0, -1, -1]], dtype=np.float32)
+
+# Gradient components by PERM index, i.e. GRAD3[PERM[i] % 12].
+GRAD_X, GRAD_Y, GRAD_Z = [GRAD3[PERM % 12, axis] for axis in range(3)]
+
+F2 = np.float32(0.3660254037844386)
+G2 = np.float32(0.21132486540518713)
+F3 = np.float32(1.)/np.float32(3.)
+G3 = np.float32(1.)/np.float32(6.)
+
+# Points evaluated per block. Small enough for the temporaries to stay in
+# cache.
+BLOCK_SIZE = 1 << 13
+# Points per task when a field is split across processes.
+TILE_SIZE = 1 << 18
+
+def f32(value):
+    return np.float32(value)
+
+def lattice(v):
+    # floorf(v), and (int) floorf(v) & 255 as an index.
+    truncated = v.astype(np.int32).astype(np.float32)
+    floor = truncated - (v < truncated).view(np.uint8)
+    return floor, floor.astype(np.intp) & 255
+
+def add_corner(total, index, radius, *offsets):
+    # Adds one corner's contribution, f^4 times the gradient's dot product
+    # with the offset where f = radius - |offset|^2 is positive. Every
+    # gradient has a zero component, so the dot product is rounded once
+    # whichever order it's summed in.
+    f = radius - offsets[0]*offsets[0]
+    dot = GRAD_X.take(index)*offsets[0]
+    for offset, grad in zip(offsets[1:], (GRAD_Y, GRAD_Z)):
+        f -= offset*offset
+        dot += grad.take(index)*offset
+    np.clip(f, 0, None, out=f)
+    dot *= f*f*f*f
+    total += dot
+
+def noise2(x, y):
+    s = (x + y)*F2
+    i, I = lattice(x + s)
+    j, J = lattice(y + s)
+    t = (i + j)*G2
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    i1 = (x0 > y0).view(np.uint8)
+    j1 = 1 - i1
+    total = np.zeros_like(x)
+    radius = f32(0.5)
+    add_corner(total, I + PERM.take(J), radius, x0, y0)
+    add_corner(total, I + i1 + PERM.take(J + j1), radius, x0 - i1 + G2,
+        y0 - j1 + G2)
+    add_corner(total, I + 1 + PERM.take(J + 1), radius,
+        x0 + G2*f32(2) - f32(1), y0 + G2*f32(2) - f32(1))
+    total *= f32(70)
+    return total
+
+def noise3(x, y, z):
+    s = (x + y + z)*F3
+    i, I = lattice(x + s)
+    j, J = lattice(y + s)
+    k, K = lattice(z + s)
+    t = (i + j + k)*G3
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    z0 = z - (k - t)
+    # Which of the six simplices the point is in, as the offsets of its
+    # second and third corners.
+    xy = x0 >= y0
+    yz = y0 >= z0
+    xz = x0 >= z0
+    o1 = [xy & (yz | xz), ~xy & yz]
+    o1.append(~(o1[0] | o1[1]))
+    o2 = [xy | (yz & xz), ~xy | yz]
+    o2.append(~(o2[0] & o2[1]))
+    total = np.zeros_like(x)
+    radius = f32(0.6)
+    add_corner(total, I + PERM.take(J + PERM.take(K)), radius, x0, y0, z0)
+    for o, G in [(o1, G3), (o2, f32(2)*G3)]:
+        ox, oy, oz = [c.view(np.uint8) for c in o]
+        add_corner(total, I + ox + PERM.take(J + oy + PERM.take(K + oz)),
+            radius, x0 - ox + G, y0 - oy + G, z0 - oz + G)
+    G = f32(3)*G3
+    add_corner(total, I + 1 + PERM.take(J + 1 + PERM.take(K + 1)), radius,
+        x0 - f32(1) + G, y0 - f32(1) + G, z0 - f32(1) + G)
+    total *= f32(32)
+    return total
+
+def fast_sin(x):
+    # Takes x in half turns, like the C version.
+    z = x + f32(25165824)
+    x = x - (z - f32(25165824))
+    y = x - x*np.abs(x)
+    return y*(f32(3.1) + f32(3.6)*np.abs(y))
+
+def fast_cos(x):
+    return fast_sin(x + f32(0.5))
+
+def fbm(noise, coordinates, octaves, persistence, lacunarity, offset=None):
+    # offset, if given, is added to every coordinate after it's scaled.
+    def octave(freq):
+        scaled = [c*freq for c in coordinates]
+        if offset is not None:
+            scaled = [c + offset for c in scaled]
+        return noise(*scaled)
+    freq = f32(1)
+    amp = f32(1)
+    total_amp = f32(1)
+    total = octave(freq)
+    for i in range(1, octaves):
+        freq *= lacunarity
+        amp *= persistence
+        total_amp += amp
+        total += octave(freq)*amp
+    return total/total_amp
+
+def wrap(v, repeat):
+    # A tiled axis becomes a circle in an extra dimension.
+    angle = (v.astype(np.float64)*2./np.float64(repeat)).astype(np.float32)
+    radius = f32(np.float64(repeat)/np.pi*0.5)
+    return fast_sin(angle)*radius, fast_cos(angle)*radius
+
+def field(args):
+    # snoise2 over flat float32 arrays of points.
+    x, y, octaves, persistence, lacunarity, repeatx, repeaty, base = args
+    result = np.empty(len(x))
+    for start in range(0, len(x), BLOCK_SIZE):
+        bx = x[start:start+BLOCK_SIZE]
+        by = y[start:start+BLOCK_SIZE]
+        if repeatx is not None:
+            bx, w = wrap(bx, repeatx)
+            block = fbm(noise3, (bx, by, base + w), octaves, persistence,
+                lacunarity)
+        elif repeaty is not None:
+            by, w = wrap(by, repeaty)
+            block = fbm(noise3, (bx, by, base + w), octaves, persistence,
+                lacunarity)
+        else:
+            block = fbm(noise2, (bx, by), octaves, persistence, lacunarity,
+                base)
+        result[start:start+BLOCK_SIZE] = block
+    return result
+
+def snoise2(x, y, octaves=1, persistence=0.5, lacunarity=2.0, repeatx=None,
+            repeaty=None, base=0.0, workers=1):
+    # As noise.snoise2, but x and y may be arrays, broadcast against each
+    # other. Tiling in both directions isn't supported. Large fields are
+    # split into tiles across workers processes (None for one per CPU).
+    if octaves <= 0:
+        raise ValueError("Expected octaves value > 0")
+    if repeatx is not None and repeaty is not None:
+        raise ValueError("Can't tile in both directions")
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float32),
+                               np.asarray(y, dtype=np.float32))
+    shape = x.shape
+    x = x.ravel()
+    y = y.ravel()
+    settings = (octaves, f32(persistence), f32(lacunarity),
+        None if repeatx is None else f32(repeatx),
+        None if repeaty is None else f32(repeaty), f32(base))
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1 or len(x) <= TILE_SIZE:
+        return field((x, y) + settings).reshape(shape)
+    pool = multiprocessing.Pool(workers)
+    try:
+        tiles = pool.map(field, [(x[start:start+TILE_SIZE],
+                                  y[start:start+TILE_SIZE]) + settings
+                                 for start in range(0, len(x), TILE_SIZE)])
+    finally:
+        pool.close()
+        pool.join()
+    return np.concatenate(tiles).reshape(shape)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import lazy
+import os
+import perf
+import threading
+import time
+
+sqlite3 = lazy.load("sqlite3")
+
+# A data path ending in one of these is a single-file campaign database.
+SQLITE_EXTENSIONS = (".sqlite", ".db")
+
+_storages = {}
+
+class FileStorage(object):
+    # The original layout: loose files under the data directory. Paths are
+    # relative to it and include the extension, e.g. "creatures/goblin.json".
+    def __init__(self, data_path):
+        self.data_path = data_path
+    def local_path(self, name):
+        return self.data_path + name
+    def mtime(self, path):
+        try:
+            return os.path.getmtime(self.data_path + path)
+        except OSError:
+            raise IOError("No such file: %s%s"%(self.data_path, path))
+    def isfile(self, path):
+        return os.path.isfile(self.data_path + path)
+    def listdir(self, directory):
+        return os.listdir(self.data_path + directory)
+    def read(self, path):
+        perf.count("file opens")
+        with open(self.data_path + path, 'rb') as f:
+            return f.read()
+    def write(self, path, data):
+        perf.count("file opens")
+        with open(self.data_path + path, 'wb') as f:
+            f.write(data)
+    def paths(self):
+        for root, directories, files in os.walk(self.data_path):
+            for name in files:
+                yield os.path.relpath(os.path.join(root, name),
+                    self.data_path).replace(os.sep, "/")
+    def query(self, **criteria):
+        # A full scan; the SQLite backend answers from its indexes.
+        matches = []
+        for path in self.paths():
+            if path.endswith(".json"):
+                try:
+                    entity = json.loads(self.read(path))
+                except ValueError:
+                    continue
+                if matches_criteria(get_metadata(entity), criteria):
+                    matches.append(path)
+        return sorted(matches)
+
+class SQLiteStorage(object):
+    # Every file of the data directory as a row, with the fields worth
+    # searching on pulled out into indexed columns.
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+    @property
+    def db(self):
+        # Threads and worker processes each need their own connection.
+        if getattr(self.local, "pid", None) != os.getpid():
+            connection = self.local.connection = sqlite3.connect(self.path)
+            connection.text_factory = str
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY, directory TEXT, data BLOB,
+                    mtime REAL, name TEXT, cr REAL, type TEXT, next TEXT);
+                CREATE INDEX IF NOT EXISTS files_directory
+                    ON files (directory);
+                CREATE INDEX IF NOT EXISTS files_name ON files (name);
+                CREATE INDEX IF NOT EXISTS files_cr_type ON files (cr, type);
+                CREATE INDEX IF NOT EXISTS files_next ON files (next);
+                """)
+            self.local.pid = os.getpid()
+        return self.local.connection
+    def local_path(self, name):
+        return "%s.%s"%(self.path, name)
+    def mtime(self, path):
+        row = self.db.execute("SELECT mtime FROM files WHERE path = ?",
+            (path,)).fetchone()
+        if row is None:
+            # Directories have no row; their "mtime" changes whenever a file
+            # in them is added, removed or written.
+            row = self.db.execute("SELECT count(*), max(mtime) FROM files "
+                "WHERE directory = ?", (path.rstrip("/"),)).fetchone()
+            if not row[0]:
+                raise IOError("No such file: %s in %s"%(path, self.path))
+            return row
+        return row[0]
+    def isfile(self, path):
+        return self.db.execute("SELECT 1 FROM files WHERE path = ?",
+            (path,)).fetchone() is not None
+    def listdir(self, directory):
+        return [path.rsplit("/", 1)[-1] for (path,) in self.db.execute(
+            "SELECT path FROM files WHERE directory = ?",
+            (directory.rstrip("/"),))]
+    def read(self, path):
+        perf.count("database reads")
+        row = self.db.execute("SELECT data FROM files WHERE path = ?",
+            (path,)).fetchone()
+        if row is None:
+            raise IOError("No such file: %s in %s"%(path, self.path))
+        return str(row[0])
+    def write(self, path, data, mtime=None):
+        metadata = {}
+        if path.endswith(".json"):
+            try:
+                metadata = get_metadata(json.loads(data))
+            except ValueError:
+                pass
+        directory = path.rsplit("/", 1)[0] if "/" in path else ""
+        self.db.execute("INSERT OR REPLACE INTO files VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?)", (path, directory, sqlite3.Binary(data),
+            mtime or time.time(), metadata.get("name"), metadata.get("cr"),
+            metadata.get("type"), metadata.get("next")))
+        self.db.commit()
+    def paths(self):
+        return [path for (path,) in
+                self.db.execute("SELECT path FROM files ORDER BY path")]
+    def query(self, **criteria):
+        where = "".join(" AND %s = ?"%column for column in sorted(criteria))
+        return [path for (path,) in self.db.execute(
+            "SELECT path FROM files WHERE path LIKE '%%.json'%s "
+            "ORDER BY path"%where,
+            [criteria[column] for column in sorted(criteria)])]
+
+def parse_cr(cr):
+    if cr is None:
+        return None
+    cr = str(cr)
+    if "/" in cr:
+        numerator, denominator = cr.split("/")
+        return float(numerator)/float(denominator)
+    return float(cr)
+
+def get_metadata(entity):
+    if not isinstance(entity, dict):
+        return {}
+    return {"name": entity.get("name"),
+            "cr": parse_cr(entity.get("cr", entity.get("challenge_rating"))),
+            "type": entity.get("type"),
+            "next": entity.get("next")}
+
+def matches_criteria(metadata, criteria):
+    return all(metadata.get(column) == value
+               for column, value in criteria.items())
+
+def parse_criteria(string):
+    # "cr=3 type=undead" -> {"cr": 3.0, "type": "undead"}
+    criteria = {}
+    for term in string.split():
+        column, _, value = term.partition("=")
+        if column not in ("name", "cr", "type", "next"):
+            raise ValueError("Can't search on %s"%column)
+        criteria[column] = parse_cr(value) if column == "cr" else value
+    return criteria
+
+def open_storage(data_path):
+    if data_path not in _storages:
+        if data_path.endswith(SQLITE_EXTENSIONS):
+            _storages[data_path] = SQLiteStorage(data_path)
+        else:
+            _storages[data_path] = FileStorage(data_path)
+    return _storages[data_path]
+
+def copy(source, destination):
+    for path in source.paths():
+        destination.write(path, source.read(path))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Pack a data directory into a SQLite file or unpack it.")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("directory")
+    parser.add_argument("database")
+    args = parser.parse_args()
+
+    directory = FileStorage(os.path.join(args.directory, ""))
+    database = SQLiteStorage(args.database)
+    if args.command == "import":
+        copy(directory, database)
+    else:
+        for path in database.paths():
+            if "/" in path and not os.path.isdir(
+                    directory.local_path(path.rsplit("/", 1)[0])):
+                os.makedirs(directory.local_path(path.rsplit("/", 1)[0]))
+        copy(database, directory)
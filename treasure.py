@@ -0,0 +1,338 @@
+from collections import OrderedDict
+import config
+import json
+import npc
+import numpy as np
+import rng
+import roll
+import threading
+
+COIN_VALUES = OrderedDict([("cp", 0.01), ("sp", 0.1), ("ep", 0.5),
+                           ("gp", 1), ("pp", 10)])
+
+# Treasure by CR band. A band applies from its CR up to the next band's.
+# Its coins are rolled for every creature or hoard; then a d100 picks the
+# first row whose bound it doesn't exceed. Every entry is "<roll> <what>",
+# where what is a coin or an item table. Overridden by individual.json and
+# hoard.json in data/treasure/, as lists of {"cr", "coins", "rows"}.
+DEFAULT_TABLES = \
+{
+    "individual": [
+        # CR 0 creatures carry pocket change; the next band starts at 1/8.
+        (0, ["1d10 cp"], []),
+        (0.125, [], [(30, ["5d6 cp"]), (60, ["4d6 sp"]), (70, ["3d6 ep"]),
+                 (95, ["3d6 gp"]), (100, ["1d6 pp"])]),
+        (5, [], [(30, ["4d6*100 cp", "1d6*10 ep"]),
+                 (60, ["6d6*10 sp", "2d6*10 gp"]),
+                 (70, ["3d6*10 ep", "2d6*10 gp"]),
+                 (95, ["4d6*10 gp"]),
+                 (100, ["2d6*10 gp", "3d6 pp"])]),
+        (11, [], [(20, ["4d6*100 sp", "1d6*100 gp"]),
+                  (35, ["1d6*100 ep", "1d6*100 gp"]),
+                  (75, ["2d6*100 gp", "1d6*10 pp"]),
+                  (100, ["2d6*100 gp", "2d6*10 pp"])]),
+        (17, [], [(15, ["2d6*1000 ep", "8d6*100 gp"]),
+                  (55, ["1d6*1000 gp", "1d6*100 pp"]),
+                  (100, ["1d6*1000 gp", "2d6*100 pp"])]),
+    ],
+    "hoard": [
+        (0, ["6d6*100 cp", "3d6*100 sp", "2d6*10 gp"], [
+            (6, []), (16, ["2d6 gems_10"]), (26, ["2d4 art_25"]),
+            (36, ["2d6 gems_50"]),
+            (44, ["2d6 gems_10", "1d6 magic_a"]),
+            (52, ["2d4 art_25", "1d6 magic_a"]),
+            (60, ["2d6 gems_50", "1d6 magic_a"]),
+            (65, ["2d6 gems_10", "1d4 magic_b"]),
+            (70, ["2d4 art_25", "1d4 magic_b"]),
+            (75, ["2d6 gems_50", "1d4 magic_b"]),
+            (78, ["2d6 gems_10", "1d4 magic_c"]),
+            (80, ["2d4 art_25", "1d4 magic_c"]),
+            (85, ["2d6 gems_50", "1d4 magic_c"]),
+            (92, ["2d4 art_25", "1d4 magic_f"]),
+            (97, ["2d6 gems_50", "1d4 magic_f"]),
+            (99, ["2d4 art_25", "1 magic_g"]),
+            (100, ["2d6 gems_50", "1 magic_g"])]),
+        (5, ["2d6*100 cp", "2d6*1000 sp", "6d6*100 gp", "3d6*10 pp"], [
+            (4, []), (10, ["2d4 art_25"]), (16, ["3d6 gems_50"]),
+            (22, ["3d6 gems_100"]), (28, ["2d4 art_250"]),
+            (32, ["2d4 art_25", "1d6 magic_a"]),
+            (36, ["3d6 gems_50", "1d6 magic_a"]),
+            (40, ["3d6 gems_100", "1d6 magic_a"]),
+            (44, ["2d4 art_250", "1d6 magic_a"]),
+            (49, ["2d4 art_25", "1d4 magic_b"]),
+            (54, ["3d6 gems_50", "1d4 magic_b"]),
+            (59, ["3d6 gems_100", "1d4 magic_b"]),
+            (63, ["2d4 art_250", "1d4 magic_b"]),
+            (66, ["2d4 art_25", "1d4 magic_c"]),
+            (69, ["3d6 gems_50", "1d4 magic_c"]),
+            (72, ["3d6 gems_100", "1d4 magic_c"]),
+            (74, ["2d4 art_250", "1d4 magic_c"]),
+            (76, ["2d4 art_25", "1 magic_d"]),
+            (78, ["3d6 gems_50", "1 magic_d"]),
+            (79, ["3d6 gems_100", "1 magic_d"]),
+            (80, ["2d4 art_250", "1 magic_d"]),
+            (84, ["2d4 art_25", "1d4 magic_f"]),
+            (88, ["3d6 gems_50", "1d4 magic_f"]),
+            (91, ["3d6 gems_100", "1d4 magic_f"]),
+            (94, ["2d4 art_250", "1d4 magic_f"]),
+            (96, ["3d6 gems_100", "1d4 magic_g"]),
+            (98, ["2d4 art_250", "1d4 magic_g"]),
+            (99, ["3d6 gems_100", "1 magic_h"]),
+            (100, ["2d4 art_250", "1 magic_h"])]),
+        (11, ["4d6*1000 gp", "5d6*100 pp"], [
+            (3, []), (6, ["2d4 art_250"]), (9, ["2d4 art_750"]),
+            (12, ["3d6 gems_500"]), (15, ["3d6 gems_1000"]),
+            (19, ["2d4 art_250", "1d4 magic_a", "1d6 magic_b"]),
+            (23, ["2d4 art_750", "1d4 magic_a", "1d6 magic_b"]),
+            (26, ["3d6 gems_500", "1d4 magic_a", "1d6 magic_b"]),
+            (29, ["3d6 gems_1000", "1d4 magic_a", "1d6 magic_b"]),
+            (35, ["2d4 art_250", "1d6 magic_c"]),
+            (40, ["2d4 art_750", "1d6 magic_c"]),
+            (45, ["3d6 gems_500", "1d6 magic_c"]),
+            (50, ["3d6 gems_1000", "1d6 magic_c"]),
+            (54, ["2d4 art_250", "1d4 magic_d"]),
+            (58, ["2d4 art_750", "1d4 magic_d"]),
+            (62, ["3d6 gems_500", "1d4 magic_d"]),
+            (66, ["3d6 gems_1000", "1d4 magic_d"]),
+            (68, ["2d4 art_250", "1 magic_e"]),
+            (70, ["2d4 art_750", "1 magic_e"]),
+            (72, ["3d6 gems_500", "1 magic_e"]),
+            (74, ["3d6 gems_1000", "1 magic_e"]),
+            (76, ["2d4 art_250", "1 magic_f", "1d4 magic_g"]),
+            (78, ["2d4 art_750", "1 magic_f", "1d4 magic_g"]),
+            (80, ["3d6 gems_500", "1 magic_f", "1d4 magic_g"]),
+            (82, ["3d6 gems_1000", "1 magic_f", "1d4 magic_g"]),
+            (85, ["2d4 art_250", "1d4 magic_h"]),
+            (88, ["2d4 art_750", "1d4 magic_h"]),
+            (90, ["3d6 gems_500", "1d4 magic_h"]),
+            (92, ["3d6 gems_1000", "1d4 magic_h"]),
+            (94, ["2d4 art_250", "1 magic_i"]),
+            (96, ["2d4 art_750", "1 magic_i"]),
+            (98, ["3d6 gems_500", "1 magic_i"]),
+            (100, ["3d6 gems_1000", "1 magic_i"])]),
+        (17, ["12d6*1000 gp", "8d6*1000 pp"], [
+            (2, []),
+            (5, ["3d6 gems_1000", "1d8 magic_c"]),
+            (8, ["1d10 art_2500", "1d8 magic_c"]),
+            (11, ["1d4 art_7500", "1d8 magic_c"]),
+            (14, ["1d8 gems_5000", "1d8 magic_c"]),
+            (22, ["3d6 gems_1000", "1d6 magic_d"]),
+            (30, ["1d10 art_2500", "1d6 magic_d"]),
+            (38, ["1d4 art_7500", "1d6 magic_d"]),
+            (46, ["1d8 gems_5000", "1d6 magic_d"]),
+            (52, ["3d6 gems_1000", "1d6 magic_e"]),
+            (58, ["1d10 art_2500", "1d6 magic_e"]),
+            (63, ["1d4 art_7500", "1d6 magic_e"]),
+            (68, ["1d8 gems_5000", "1d6 magic_e"]),
+            (69, ["3d6 gems_1000", "1d4 magic_g"]),
+            (70, ["1d10 art_2500", "1d4 magic_g"]),
+            (71, ["1d4 art_7500", "1d4 magic_g"]),
+            (72, ["1d8 gems_5000", "1d4 magic_g"]),
+            (74, ["3d6 gems_1000", "1d4 magic_h"]),
+            (76, ["1d10 art_2500", "1d4 magic_h"]),
+            (78, ["1d4 art_7500", "1d4 magic_h"]),
+            (80, ["1d8 gems_5000", "1d4 magic_h"]),
+            (85, ["3d6 gems_1000", "1d4 magic_i"]),
+            (90, ["1d10 art_2500", "1d4 magic_i"]),
+            (95, ["1d4 art_7500", "1d4 magic_i"]),
+            (100, ["1d8 gems_5000", "1d4 magic_i"])]),
+    ]
+}
+
+# Built-in item tables, overridden by a file of the same name in
+# data/treasure/ in the format of the NPC tables. Gems and art objects are
+# worth the gp in their table's name.
+DEFAULT_ITEMS = \
+{
+    "gems_10": ["Azurite", "Banded agate", "Blue quartz", "Eye agate",
+                "Hematite", "Lapis lazuli", "Malachite", "Moss agate",
+                "Obsidian", "Rhodochrosite", "Tiger eye", "Turquoise"],
+    "gems_50": ["Bloodstone", "Carnelian", "Chalcedony", "Chrysoprase",
+                "Citrine", "Jasper", "Moonstone", "Onyx", "Quartz",
+                "Sardonyx", "Star rose quartz", "Zircon"],
+    "gems_100": ["Amber", "Amethyst", "Chrysoberyl", "Coral", "Garnet",
+                 "Jade", "Jet", "Pearl", "Spinel", "Tourmaline"],
+    "gems_500": ["Alexandrite", "Aquamarine", "Black pearl", "Blue spinel",
+                 "Peridot", "Topaz"],
+    "gems_1000": ["Black opal", "Blue sapphire", "Emerald", "Fire opal",
+                  "Opal", "Star ruby", "Star sapphire", "Yellow sapphire"],
+    "gems_5000": ["Black sapphire", "Diamond", "Jacinth", "Ruby"],
+    "art_25": ["Silver ewer", "Carved bone statuette", "Gold bracelet",
+               "Black velvet mask", "Copper chalice", "Engraved bone dice",
+               "Embroidered silk handkerchief", "Gold locket"],
+    "art_250": ["Gold ring set with bloodstones", "Carved ivory statuette",
+                "Bronze crown", "Silk robe with gold embroidery",
+                "Fine tapestry", "Brass mug with jade inlay",
+                "Gold bird cage"],
+    "art_750": ["Silver chalice set with moonstones", "Carved harp",
+                "Small gold idol", "Ceremonial electrum dagger",
+                "Obsidian statuette with gold fittings",
+                "Painted gold war mask"],
+    "art_2500": ["Gold chain set with a fire opal", "Old masterpiece",
+                 "Platinum bracelet set with a sapphire", "Jeweled anklet",
+                 "Gold music box", "Gold circlet set with aquamarines"],
+    "art_7500": ["Jeweled gold crown", "Jeweled platinum ring",
+                 "Gold cup set with emeralds", "Jade game board with gold "
+                 "pieces", "Bejeweled ivory drinking horn"],
+    "magic_a": [("Potion of healing", 50), ("Spell scroll (cantrip)", 10),
+                ("Potion of climbing", 10), ("Spell scroll (1st level)", 20),
+                ("Spell scroll (2nd level)", 4), ("Bag of holding", 2),
+                ("Driftglobe", 2), ("Potion of greater healing", 2)],
+    "magic_b": [("Potion of greater healing", 15),
+                ("Potion of fire breath", 7), ("Potion of resistance", 7),
+                ("Ammunition, +1", 5), ("Spell scroll (2nd level)", 10),
+                ("Potion of water breathing", 5),
+                ("Spell scroll (3rd level)", 5), ("Bag of holding", 3),
+                ("Cloak of the manta ray", 1), ("Goggles of night", 1),
+                ("Wand of magic detection", 1)],
+    "magic_c": [("Potion of superior healing", 15),
+                ("Spell scroll (4th level)", 7), ("Ammunition, +2", 5),
+                ("Potion of clairvoyance", 5), ("Potion of diminution", 5),
+                ("Potion of gaseous form", 5), ("Bag of beans", 2),
+                ("Necklace of fireballs", 1), ("Portable hole", 1)],
+    "magic_d": [("Potion of supreme healing", 20),
+                ("Potion of invisibility", 10), ("Potion of speed", 10),
+                ("Spell scroll (6th level)", 10), ("Ammunition, +3", 5),
+                ("Potion of flying", 5), ("Bag of tricks", 2),
+                ("Horseshoes of speed", 1)],
+    "magic_e": [("Spell scroll (8th level)", 30),
+                ("Potion of storm giant strength", 25),
+                ("Potion of supreme healing", 15),
+                ("Spell scroll (9th level)", 15), ("Universal solvent", 8),
+                ("Arrow of slaying", 5), ("Sovereign glue", 2)],
+    "magic_f": [("Weapon, +1", 15), ("Shield, +1", 3),
+                ("Sentinel shield", 3), ("Amulet of proof against detection "
+                "and location", 2), ("Boots of elvenkind", 2),
+                ("Bracers of archery", 2), ("Cloak of elvenkind", 2),
+                ("Cloak of protection", 2), ("Gauntlets of ogre power", 2),
+                ("Hat of disguise", 2), ("Javelin of lightning", 2),
+                ("Pearl of power", 2), ("Wand of magic missiles", 2),
+                ("Wand of web", 2), ("Ring of jumping", 1),
+                ("Ring of mind shielding", 1), ("Gloves of thievery", 1)],
+    "magic_g": [("Weapon, +2", 11), ("Figurine of wondrous power", 3),
+                ("Adamantine armor", 1), ("Amulet of health", 1),
+                ("Belt of dwarvenkind", 1), ("Boots of speed", 1),
+                ("Bracers of defense", 1), ("Cloak of displacement", 1),
+                ("Flame tongue", 1), ("Ring of protection", 1),
+                ("Ring of free action", 1), ("Wand of fireballs", 1),
+                ("Wand of lightning bolts", 1), ("Armor, +1", 1)],
+    "magic_h": [("Weapon, +3", 10), ("Amulet of the planes", 2),
+                ("Carpet of flying", 2), ("Crystal ball", 2),
+                ("Ring of regeneration", 2), ("Ring of shooting stars", 2),
+                ("Ring of telekinesis", 2), ("Robe of eyes", 2),
+                ("Rod of absorption", 2), ("Staff of power", 2),
+                ("Armor, +2", 2), ("Shield, +3", 2)],
+    "magic_i": [("Defender", 5), ("Hammer of thunderbolts", 5),
+                ("Luck blade", 5), ("Sword of answering", 5),
+                ("Holy avenger", 3), ("Ring of djinni summoning", 3),
+                ("Ring of invisibility", 3), ("Ring of spell turning", 3),
+                ("Rod of lordly might", 3), ("Staff of the magi", 3),
+                ("Vorpal sword", 3), ("Armor, +3", 2),
+                ("Belt of cloud giant strength", 2), ("Cubic gate", 2),
+                ("Deck of many things", 2), ("Ring of three wishes", 1),
+                ("Sphere of annihilation", 1), ("Talisman of pure good", 1)],
+}
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+class Loot(object):
+    # Coins totalled by denomination, and items counted by table and entry.
+    def __init__(self):
+        self.coins = OrderedDict((coin, 0) for coin in COIN_VALUES)
+        self.items = OrderedDict()
+    def add(self, entry, n, random):
+        # Rolls entry for n creatures or hoards at once.
+        expression, what = entry.split()
+        total = int(roll.roll_many(expression, n).sum())
+        if what in self.coins:
+            self.coins[what] += total
+        elif total:
+            table = load_tables()["items"][what]
+            counts = np.bincount(table.sample_many(random, total),
+                minlength=len(table))
+            for i in np.flatnonzero(counts):
+                key = (what, table.entries[i])
+                self.items[key] = self.items.get(key, 0) + int(counts[i])
+    def value(self):
+        # In gp, counting gems and art objects but not magic items.
+        total = sum(COIN_VALUES[coin]*n for coin, n in self.coins.items())
+        for (table, entry), n in self.items.items():
+            total += item_value(table)*n
+        return total
+    def __str__(self):
+        lines = [", ".join("%i %s"%(n, coin)
+                           for coin, n in self.coins.items() if n) or
+                 "No coins"]
+        for (table, entry), n in sorted(self.items.items(),
+                key=lambda item: (item[0][0].partition("_")[0],
+                                  item_value(item[0][0]), item[0][1])):
+            value = item_value(table)
+            lines.append("%i %s%s"%(n, entry,
+                " (%i gp each)"%value if value else ""))
+        lines.append("Total value: %s gp"%format(self.value(), ",.2f"))
+        return "\n".join(lines)
+
+def item_value(table):
+    kind, _, value = table.partition("_")
+    return int(value) if kind in ("gems", "art") else 0
+
+def read_bands(text):
+    return [(band["cr"], band.get("coins", []),
+             [tuple(row) for row in band.get("rows", [])])
+            for band in json.loads(text)]
+
+def load_tables():
+    with _tables_lock:
+        if not _tables:
+            store = config.get_storage()
+            try:
+                filenames = store.listdir("treasure")
+            except (IOError, OSError):
+                filenames = []
+            for kind in ("individual", "hoard"):
+                if kind + ".json" in filenames:
+                    _tables[kind] = read_bands(
+                        store.read("treasure/%s.json"%kind))
+                else:
+                    _tables[kind] = DEFAULT_TABLES[kind]
+            items = _tables["items"] = {}
+            for name, rows in DEFAULT_ITEMS.items():
+                rows = [row if isinstance(row, tuple) else (row, 1)
+                        for row in rows]
+                items[name] = npc.Table([r[0] for r in rows],
+                                        [r[1] for r in rows])
+            for filename in filenames:
+                if filename.endswith(".txt"):
+                    items[filename[:-4]] = \
+                        npc.read_table(store.read("treasure/" + filename))
+    return _tables
+
+def get_band(kind, cr):
+    bands = load_tables()[kind]
+    return [band for band in bands if band[0] <= cr][-1]
+
+def roll_treasure(kind, n, cr):
+    # One d100 per creature or hoard, all drawn at once; then each row's
+    # entries are rolled once for all the draws that landed on it.
+    random = rng.stream("treasure").numpy
+    min_cr, coins, rows = get_band(kind, cr)
+    loot = Loot()
+    for entry in coins:
+        loot.add(entry, n, random)
+    if rows:
+        d100 = random.randint(1, 101, size=n)
+        counts = np.bincount(
+            np.searchsorted([row[0] for row in rows], d100),
+            minlength=len(rows))
+        for (bound, entries), count in zip(rows, counts):
+            for entry in entries:
+                if count:
+                    loot.add(entry, count, random)
+    return loot
+
+def individual(n, cr):
+    return roll_treasure("individual", n, cr)
+
+def hoard(cr, n=1):
+    return roll_treasure("hoard", n, cr)
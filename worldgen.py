@@ -1,14 +1,15 @@
 from collections import deque
+import config
 import cPickle as pickle
-import dmtools
 import matplotlib.pyplot as plt
 from matplotlib.patches import Polygon
-from noise import snoise2
 import numpy as np
 import os.path
+import rng
 from scipy.misc import imresize
 from scipy.ndimage import imread, gaussian_filter
 from scipy.spatial import Voronoi, voronoi_plot_2d
+import simplex
 
 MAP_WIDTH = 2.
 MAP_HEIGHT = 1.
@@ -36,6 +37,12 @@ TUNDRA = 11
 SNOW = 12
 
 SHADOW_STRENGTH = 2
+# The step from a pixel towards the light, as (rows, columns), how much the
+# light's ray climbs per step, and how far above a pixel its horizon must be
+# to shade it fully (0 for hard shadows).
+LIGHT_DIRECTION = (-1, -1)
+LIGHT_SLOPE = 0.5
+SHADOW_SOFTNESS = 0
 
 biome_colours = {
     OCEAN: [0, 0, 153],
@@ -53,6 +60,16 @@ biome_colours = {
     SNOW: [255, 255, 255]
 }
 
+# Biome by temperature band (rows) and moisture band (columns), and colour
+# by biome.
+BIOME_TABLE = np.array([
+    [BARE, TUNDRA, TAIGA, SNOW, OCEAN],
+    [GRASSLAND, WOODLAND, TEMPERATE_FOREST, TEMPERATE_RAINFOREST, OCEAN],
+    [DESERT, SAVANNAH, TROPICAL_SEASONAL_FOREST, TROPICAL_RAINFOREST, OCEAN]
+    ], dtype=np.uint8)
+PALETTE = np.array([biome_colours[biome] for biome in sorted(biome_colours)],
+    dtype=np.uint8)
+
 PERLIN_OCTAVES = 10
 PERLIN_PERSISTENCE = 0.7
 PERLIN_LACUNARITY = 2.0
@@ -90,7 +107,7 @@ def generate(water_level=0.15,
              seed=6,
              show_france=True):
 
-    data_path = dmtools.get_data_path()
+    data_path = config.get_data_path()
     generate_coastline(data_path, water_level, show_france, seed)
     generate_elevation(data_path, seed)
     generate_temperature(data_path)
@@ -104,13 +121,10 @@ def generate_coastline(data_path, water_level, show_france, seed):
     if os.path.isfile(data_path + "coastline.pkl"):
         # Already did this.
         return
-    data = np.zeros((IMAGE_HEIGHT, IMAGE_WIDTH))
-    for i in range(IMAGE_HEIGHT):
-        for j in range(IMAGE_WIDTH):
-            data[i,j] = get_elevation(
-                MAP_WIDTH*(float(j)/IMAGE_WIDTH),
-                MAP_HEIGHT*(float(i)/IMAGE_HEIGHT),
-                seed)
+    data = get_elevation(
+        MAP_WIDTH*(np.arange(IMAGE_WIDTH)/float(IMAGE_WIDTH)),
+        MAP_HEIGHT*(np.arange(IMAGE_HEIGHT)/float(IMAGE_HEIGHT))[:,None],
+        seed)
     
     pickle.dump(data, open(data_path+"rough_elevation.pkl", 'wb'))
     data = rescale(data)
@@ -137,12 +151,11 @@ def generate_elevation(data_path, seed):
     coastline = pickle.load(open(data_path+"coastline.pkl", 'rb'))
     elevation = pickle.load(open(data_path+"rough_elevation.pkl", 'rb'))
 
-    for i in range(IMAGE_HEIGHT):
-        for j in range(IMAGE_WIDTH):
-            elevation[i,j] += get_elevation(
-                    MAP_WIDTH*DETAIL_SCALE*(float(j)/IMAGE_WIDTH),
-                    MAP_HEIGHT*DETAIL_SCALE*(float(i)/IMAGE_HEIGHT),
-                    seed)
+    elevation += get_elevation(
+        MAP_WIDTH*DETAIL_SCALE*(np.arange(IMAGE_WIDTH)/float(IMAGE_WIDTH)),
+        MAP_HEIGHT*DETAIL_SCALE*
+            (np.arange(IMAGE_HEIGHT)/float(IMAGE_HEIGHT))[:,None],
+        seed)
     elevation = np.exp(REDIST_STRENGTH*elevation)
     elevation = coastline * elevation
     plt.imshow(elevation)
@@ -173,13 +186,10 @@ def generate_wind(data_path, seed):
     if os.path.isfile(data_path + "wind.pkl"):
         return
 
-    wind = np.zeros((NGRID_Y, NGRID_X))
-    for i in range(NGRID_Y):
-        for j in range(NGRID_X):
-            wind[i,j] = snoise2(float(i)/NGRID_X, float(j)/NGRID_Y,
-                    octaves=WIND_OCTAVES, persistence=0.5,
-                    lacunarity=PERLIN_LACUNARITY, base=seed,
-                    repeatx=1)
+    wind = simplex.snoise2(np.arange(NGRID_Y)[:,None]/float(NGRID_X),
+        np.arange(NGRID_X)/float(NGRID_Y), octaves=WIND_OCTAVES,
+        persistence=0.5, lacunarity=PERLIN_LACUNARITY, base=seed, repeatx=1,
+        workers=None)
     wind = rescale(wind)
     plt.imshow(wind)
     plt.show()
@@ -192,26 +202,16 @@ def generate_moisture(data_path):
     elevation = pickle.load(open(data_path+"elevation.pkl", 'rb'))
     scaled_elevation = imresize(elevation, (NGRID_Y, NGRID_X))
     wind = pickle.load(open(data_path+"wind.pkl", 'rb'))
-    moisture = np.zeros((NGRID_Y, NGRID_X))
-    for i in range(NGRID_Y):
-        for j in range(NGRID_X):
-            if scaled_elevation[i,j] > 0:
-                d = 1
-                y = j
-                x = i
-                for dist in range(MAX_MOISTURE_TRAVEL):
-                    d += MOISTURE_ELEVATION_PENALTY*scaled_elevation[x,y]
-                    if wind[x,y] > 0.5:
-                        y -= 1
-                    elif wind[x,y] < -0.5:
-                        y += 1
-                    else:
-                        x += 1
-                    x = x%NGRID_Y
-                    y = y%NGRID_X
-                    if scaled_elevation[x,y] < 1:
-                        break
-                moisture[i,j] = d
+    # Each land cell's moisture is 1 plus the penalty for the elevation
+    # along its wind path, up to MAX_MOISTURE_TRAVEL cells or the ocean. The
+    # ocean is made a dead end that adds nothing, so every path is exactly
+    # MAX_MOISTURE_TRAVEL cells long and the sums can share their suffixes.
+    land = scaled_elevation > 0
+    successor = np.where(land, wind_successors(wind),
+        np.arange(land.size).reshape(land.shape))
+    climb = path_sums(successor.ravel(), scaled_elevation.ravel(),
+        MAX_MOISTURE_TRAVEL).reshape(land.shape)
+    moisture = np.where(land, 1 + MOISTURE_ELEVATION_PENALTY*climb, 0)
     moisture = 1 - np.divide(moisture, np.amax(moisture))
     # Smooth moisture map
     moisture = gaussian_filter(moisture, 2)
@@ -227,67 +227,46 @@ def generate_biomes(data_path):
     moisture = imresize(moisture, (IMAGE_HEIGHT, IMAGE_WIDTH))
     plt.imshow(moisture)
     plt.show()
-    moisture = np.digitize(moisture, [0, 100, 170, 230, 255])-1
-    moisture[moisture > 4] = 4
+    moisture = bands(moisture, [0, 100, 170, 230, 255], 4)
     plt.imshow(moisture)
     plt.show()
     temp = pickle.load(open(data_path+"temperature.pkl", 'rb'))
     temp = imresize(temp, (IMAGE_HEIGHT, IMAGE_WIDTH))
     plt.imshow(temp)
     plt.show()
-    temp = np.digitize(temp, [0, 90, 130, 255])-1
-    temp[temp > 2] = 2
+    temp = bands(temp, [0, 90, 130, 255], 2)
     plt.imshow(temp)
     plt.show()
 
-    biomes = [
-        [BARE, TUNDRA, TAIGA, SNOW, OCEAN],
-        [GRASSLAND, WOODLAND, TEMPERATE_FOREST, TEMPERATE_RAINFOREST, OCEAN],
-        [DESERT, SAVANNAH, TROPICAL_SEASONAL_FOREST, TROPICAL_RAINFOREST, OCEAN]
-        ]
-    img = np.zeros((IMAGE_HEIGHT, IMAGE_WIDTH))
-    for i in range(IMAGE_HEIGHT):
-        for j in range(IMAGE_WIDTH):
-            img[i,j] = biomes[temp[i,j]][moisture[i,j]]
+    img = BIOME_TABLE[temp, moisture]
     elevation = pickle.load(open(data_path+"elevation.pkl", 'rb'))
     img[elevation == 0] = OCEAN
     plt.imshow(img)
     plt.show()
     pickle.dump(img, open(data_path+"biomes.pkl", 'wb'))
 
-def render_image(data_path):
+def render_image(data_path, direction=LIGHT_DIRECTION, slope=LIGHT_SLOPE,
+                 softness=SHADOW_SOFTNESS):
     elevation = pickle.load(open(data_path+"elevation.pkl", 'rb'))
     biomes = pickle.load(open(data_path+"biomes.pkl", 'rb'))
 
-    final_image = np.zeros((IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.uint8)
-    for i in range(IMAGE_HEIGHT):
-        for j in range(IMAGE_WIDTH):
-            final_image[i,j,:] = biome_colours[biomes[i,j]]
-
-    noise1 = np.random.randint(20, size=(IMAGE_HEIGHT, IMAGE_WIDTH, 1))
-    noise2 = np.random.randint(20, size=(IMAGE_HEIGHT, IMAGE_WIDTH, 1))
-    noise1 = np.tile(noise1, (1,1,3))
-    noise2 = np.tile(noise2, (1,1,3))
-    noise1[final_image > 255-noise1] = 0
-    noise2[final_image < noise2] = 0
-    final_image += noise1.astype(np.uint8)
-    final_image -= noise2.astype(np.uint8)
+    # Older biome maps were saved as floats.
+    final_image = PALETTE[biomes.astype(np.uint8)]
+
+    random = rng.stream("worldgen").numpy
+    noise1 = random.randint(20, size=(IMAGE_HEIGHT, IMAGE_WIDTH, 1))
+    noise2 = random.randint(20, size=(IMAGE_HEIGHT, IMAGE_WIDTH, 1))
+    noise1 = noise1.astype(np.uint8)
+    noise2 = noise2.astype(np.uint8)
+    noise1 = np.where(final_image > 255-noise1, 0, noise1)
+    noise2 = np.where(final_image < noise2, 0, noise2)
+    final_image += noise1
+    final_image -= noise2
     
     # Light the image
-    light = [12, 0.5] # [distance, elevation]
-    sign = -light[0]/abs(light[0])
-    shadows = np.zeros((IMAGE_HEIGHT, IMAGE_WIDTH, 3))
-    for i in range(IMAGE_HEIGHT):
-        for j in range(IMAGE_WIDTH):
-            for di, x in enumerate(range(i+1, i-(light[0]+1), sign)):
-                y = j+sign*(di+1)
-                if x > 0 and x < IMAGE_HEIGHT \
-                and y > 0 and y < IMAGE_WIDTH:
-                    if elevation[x,y] > di*light[1] + elevation[i,j] and \
-                        elevation[i,j] > 0:
-                        shadows[i,j] = 1
-                        break
-    final_image[shadows == 1] /= SHADOW_STRENGTH
+    darkness = shadows(elevation, direction, slope, softness)
+    shade = 1 - darkness*np.float32(1 - 1./SHADOW_STRENGTH)
+    final_image = (final_image*shade[:,:,None]).astype(np.uint8)
     plt.imshow(final_image)
     plt.show()
 	
@@ -312,6 +291,81 @@ def generate_map(data_path, grid_x=200, grid_y=100):
 def generate_history(data_path):
     geography = generate_map(data_path)
    
+def horizon(elevation, direction, slope):
+    # The highest the terrain towards the light reaches over each pixel's
+    # ray: the max of elevation[p + k*direction] - (k-1)*slope for k >= 1.
+    # It's swept a row at a time from the side nearest the light, since
+    # ceiling[p] = max(elevation[p], ceiling[p + direction] - slope).
+    dy, dx = direction
+    if dy not in (-1, 0, 1) or dx not in (-1, 0, 1):
+        raise ValueError("The light's direction must be a step to one of "
+                         "the 8 neighbouring pixels, not %s"%(direction,))
+    if dy == 0 and dx == 0:
+        raise ValueError("The light needs a direction")
+    if dy == 0:
+        return horizon(np.ascontiguousarray(elevation.T), (dx, 0), slope).T
+    if dy > 0:
+        return horizon(elevation[::-1], (-dy, dx), slope)[::-1]
+    height, width = elevation.shape
+    result = np.empty(elevation.shape)
+    ceiling = np.full(width, -np.inf)
+    for i in range(height):
+        above = np.full(width, -np.inf)
+        if dx > 0:
+            above[:-1] = ceiling[1:]
+        elif dx < 0:
+            above[1:] = ceiling[:-1]
+        else:
+            above[:] = ceiling
+        result[i] = above
+        ceiling = np.maximum(elevation[i], above - slope)
+    return result
+
+def shadows(elevation, direction=LIGHT_DIRECTION, slope=LIGHT_SLOPE,
+            softness=SHADOW_SOFTNESS):
+    # How shaded each land pixel is, from 0 to 1.
+    height = horizon(elevation, direction, slope) - elevation
+    if softness:
+        darkness = np.clip(height/softness, 0, 1)
+    else:
+        darkness = height > 0
+    darkness = darkness.astype(np.float32)
+    darkness[elevation <= 0] = 0
+    return darkness
+
+def bands(image, edges, top):
+    # The band each value of a uint8 image falls in, as np.digitize(image,
+    # edges) - 1 capped at top, by way of a table of all 256 values.
+    table = np.minimum(np.digitize(np.arange(256), edges) - 1, top)
+    return table.astype(np.uint8)[image]
+
+def wind_successors(wind):
+    # The flat index of the cell the wind blows each cell's moisture into:
+    # west, east or else south, wrapping around the map.
+    rows, columns = np.indices(wind.shape)
+    west = wind > 0.5
+    east = wind < -0.5
+    columns = columns - west + (east & ~west)
+    rows = rows + ~(west | east)
+    return np.ravel_multi_index((rows, columns), wind.shape, mode='wrap')
+
+def path_sums(successor, weight, steps):
+    # The sum of weight over the first steps cells of the path that follows
+    # successor from each cell, by doubling: jump and total cover 2**k steps.
+    position = np.arange(len(successor))
+    result = np.zeros(len(successor), dtype=np.int64)
+    jump = successor
+    total = weight.astype(np.int64)
+    while steps:
+        if steps & 1:
+            result += total[position]
+            position = jump[position]
+        steps >>= 1
+        if steps:
+            total = total + total[jump]
+            jump = jump[jump]
+    return result
+
 def rescale(array):
     array -= (np.amin(array))
     array /= np.amax(array)
@@ -319,21 +373,23 @@ def rescale(array):
     return array
     
 def get_elevation(x, y, seed=0):
+    # x and y may be arrays.
     e = 0
-    e += DETAIL*snoise2(CONTINENT_SCALE*x, CONTINENT_SCALE*y,
+    e += DETAIL*simplex.snoise2(CONTINENT_SCALE*x, CONTINENT_SCALE*y,
         octaves=PERLIN_OCTAVES,
         persistence=PERLIN_PERSISTENCE, lacunarity=PERLIN_LACUNARITY,
-        base=seed, repeatx=MAP_WIDTH*CONTINENT_SCALE)
+        base=seed, repeatx=MAP_WIDTH*CONTINENT_SCALE, workers=None)
     return e
 
 def generate_mountains(region, dir, det, dropoff, noise):
     regions = region.neighbours
+    random = rng.stream("worldgen").numpy
     for other_region in regions:
         new_dir = np.asarray(other_region.coords)-np.asarray(region.coords)
         closeness = np.abs(np.dot(dir, new_dir))
         mountain_prob = closeness*det
-        noise_var = noise*np.random.randn()
-        if np.random.uniform() < mountain_prob:
+        noise_var = noise*random.randn()
+        if random.uniform() < mountain_prob:
             # continue with mountain
             other_region.elevation = region.elevation + noise_var
         else: